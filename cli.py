@@ -0,0 +1,441 @@
+# headless compiler: applies a hack to a base rom without the editor (and without Qt).
+# with --batch, runs every job in a manifest (see loadManifest) on a process pool.
+# with --watch, recompiles whenever the hack changes (see watch).
+#
+# exit codes:
+#   0 - success
+#   1 - the hack compiled with errors, or an output couldn't be written (in batch mode: for any job)
+#   2 - bad arguments, or the base rom / hack couldn't be read
+
+import sys
+import os
+import json
+import re
+import argparse
+import contextlib
+import multiprocessing
+import concurrent.futures
+import hashlib
+import queue
+import time
+import rom
+import model
+
+try:
+    # optional; the hack is polled for changes otherwise
+    import watchdog.observers
+    import watchdog.events
+except ImportError:
+    watchdog = None
+
+EXIT_OK = 0
+EXIT_ERRORS = 1
+EXIT_USAGE = 2
+
+# seconds between checks for changes to the hack when watchdog isn't available
+WATCH_POLL_INTERVAL = 0.5
+# seconds to wait for a change to settle (editors often write a file in several steps)
+WATCH_SETTLE_TIME = 0.2
+
+# "BANK:START-END" in hex (e.g. 3:7F00-8000) -> (bank, start, end)
+def parseFreeRange(text):
+    try:
+        bank, span = text.split(":")
+        start, end = span.split("-")
+        return int(bank, 16), int(start, 16), int(end, 16)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected BANK:START-END in hex, got {text!r}")
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]),
+        description=f"RevEdit {model.VERSION_NAME} headless compiler. Applies a hack (.json) to a base rom and writes a rom and/or patch."
+    )
+    parser.add_argument("--base", help="base rom to apply the hack to")
+    parser.add_argument("--hack", help="hack (.json) to apply; if omitted, the base rom's own data is recompiled")
+    parser.add_argument("-o", "--out", help="write the resulting rom here")
+    parser.add_argument("--ips", help="write an IPS patch (from the base rom) here")
+    parser.add_argument("--bps", help="write a BPS patch (from the base rom) here")
+    parser.add_argument("--report", help="write a json report (region usage, errors, outputs) here; '-' for stdout")
+    parser.add_argument("--profile", action="store_true", help="include a per-phase compile profile in the report")
+    parser.add_argument("--debug-dir", help="write region dumps, subrange maps and remap tables to this directory")
+    parser.add_argument("--parallel", type=int, metavar="N", help="compile independent regions with N worker processes (0: one per cpu)")
+    parser.add_argument("--pack", type=float, metavar="SECONDS", help="spend up to SECONDS overlapping ScreenTiles and entity data")
+    parser.add_argument("--daemon", nargs="?", const="", metavar="ADDRESS", help="compile with a running daemon.py (at its default address unless one is given); compiles locally if none is running")
+    parser.add_argument("--watch", action="store_true", help="keep running, and recompile whenever the hack changes")
+    parser.add_argument("--batch", metavar="MANIFEST", help="run every job in the given manifest (.json) instead of a single compile")
+    parser.add_argument("--jobs", type=int, default=0, metavar="N", help="with --batch, run N jobs at once (0: one per cpu)")
+    parser.add_argument("--compact-chunks", action="store_true", help="merge duplicate chunks and drop unused ones (renumbers chunks; see model.compactChunks)")
+    parser.add_argument("--free", type=parseFreeRange, action="append", metavar="BANK:START-END", help="a rom range (hex, end exclusive) known to be unused, for patches and overflowing screens to be placed in; can be repeated")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print errors")
+    return parser.parse_args(argv)
+
+# base roms read by this process: path -> JSONDict(mtime, gb, j)
+# in batch mode each worker keeps its own, so a base rom is read once per worker rather than once per job.
+# j (the base rom's own data) is only extracted if a job without a hack needs it.
+baseRomCache = dict()
+
+# makes the given base rom current (see rom.readrom); returns (gb, j), j being None unless extract is set
+def getBaseRom(path, extract=False):
+    mtime = os.path.getmtime(path)
+    entry = baseRomCache.get(path, None)
+    if entry is None or entry.mtime != mtime:
+        with open(path, "rb") as f:
+            entry = model.JSONDict(mtime=mtime, gb=f.read(), j=None)
+        baseRomCache[path] = entry
+    if extract and entry.j is None:
+        _, entry.j = model.loadRom(path)
+    else:
+        rom.readrom(entry.gb)
+    return entry.gb, entry.j
+
+# returns (gb, j), or raises an Exception with a readable message
+def loadInputs(basePath, hackPath):
+    if not os.path.exists(basePath):
+        raise Exception(f"not found: {basePath}")
+    if hackPath is None:
+        return getBaseRom(basePath, True)
+    if not os.path.exists(hackPath):
+        raise Exception(f"not found: {hackPath}")
+    # no need to extract the base rom's data if it's about to be replaced
+    gb, _ = getBaseRom(basePath)
+    with open(hackPath, "r") as f:
+        j = json.load(f, object_hook=model.JSONDict)
+    return gb, j
+
+def getSaveOptions(args):
+    kwargs = dict()
+    if args.ips is not None:
+        kwargs["ipsPath"] = args.ips
+    if args.bps is not None:
+        kwargs["bpsPath"] = args.bps
+    if args.profile:
+        kwargs["profile"] = True
+    if args.debug_dir is not None:
+        kwargs["debugDir"] = args.debug_dir
+    if args.parallel is not None:
+        kwargs["parallel"] = True if args.parallel == 0 else args.parallel
+    if args.pack is not None:
+        kwargs["packBudget"] = args.pack
+    if args.compact_chunks:
+        kwargs["compactChunks"] = True
+    if args.free is not None:
+        kwargs["freeRanges"] = args.free
+    return kwargs
+
+# compiles j onto gb; returns a json-friendly report
+# (the profile option here is just a flag, as it may have come from a json request)
+def compileHack(gb, j, outPath, **kwargs):
+    profile = model.Profile() if kwargs.pop("profile", False) else None
+    regions, errors = model.saveRom(gb, j, outPath, profile=profile, **kwargs)
+    report = model.JSONDict(
+        success=len(errors) == 0,
+        errors=errors,
+        regions=model.JSONDict({
+            region.name: model.JSONDict(used=region.used, max=region.max)
+            for region in regions
+        }),
+        outputs=[path for path in [outPath, kwargs.get("ipsPath", None), kwargs.get("bpsPath", None)] if path is not None],
+    )
+    if profile is not None:
+        report.profile = profile.result
+    return report
+
+# has a running daemon (see daemon.py) compile instead; returns the report.
+# raises an OSError if no daemon is running.
+def compileWithDaemon(args):
+    import daemon
+    def abspath(path):
+        return None if path is None else os.path.abspath(path)
+    kwargs = getSaveOptions(args)
+    kwargs.pop("ipsPath", None)
+    kwargs.pop("bpsPath", None)
+    if "debugDir" in kwargs:
+        kwargs["debugDir"] = abspath(kwargs["debugDir"])
+    response = daemon.request(model.JSONDict(
+        op="compile",
+        base=abspath(args.base),
+        hack=abspath(args.hack),
+        out=abspath(args.out),
+        ips=abspath(args.ips),
+        bps=abspath(args.bps),
+        options=kwargs,
+    ), args.daemon or None)
+    if not response.ok:
+        raise Exception(response.error)
+    return response.report
+
+def printReport(report, quiet=False):
+    if not quiet:
+        for name, region in report.regions.items():
+            # (regions not reached by a failed compile have no usage)
+            used = region.used or 0
+            print(f"{name:<24} {used:5X} / {region.max:5X} ({100 * used / max(region.max, 1):5.1f}%)")
+        for path in report.outputs:
+            if os.path.exists(path):
+                print(f"wrote {path}")
+    for error in report.errors:
+        print("ERROR:", error, file=sys.stderr)
+
+def writeReport(report, path):
+    if path == "-":
+        json.dump(report, sys.stdout, indent=4)
+        print()
+    else:
+        with open(path, "w") as f:
+            json.dump(report, f, indent=4)
+
+# a manifest is a json list of jobs (or an object with a "jobs" list), each job being an object with:
+#   base: path to the base rom
+#   hack: path to the hack .json (optional)
+#   out, ips, bps: where to write the rom / patches (at least one is required)
+#   name: how the job appears in the report (optional)
+# relative paths are relative to the manifest.
+def loadManifest(path):
+    with open(path, "r") as f:
+        manifest = json.load(f, object_hook=model.JSONDict)
+    if isinstance(manifest, dict):
+        manifest = manifest.get("jobs", None)
+    if not isinstance(manifest, list):
+        raise Exception(f"{path}: expected a list of jobs")
+    root = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for i, job in enumerate(manifest):
+        if not isinstance(job, dict) or "base" not in job:
+            raise Exception(f"{path}: job {i} has no base rom")
+        if all(job.get(key, None) is None for key in ["out", "ips", "bps"]):
+            raise Exception(f"{path}: job {i} has no outputs (out, ips or bps)")
+        for key in ["base", "hack", "out", "ips", "bps"]:
+            if job.get(key, None) is not None:
+                job[key] = os.path.join(root, job[key])
+        if "name" not in job:
+            job.name = os.path.basename(job.get("hack", None) or job.base)
+        jobs.append(job)
+    return jobs
+
+# runs one manifest job (in a worker process); returns its report
+def runBatchJob(job, kwargs):
+    kwargs = dict(kwargs)
+    if job.get("ips", None) is not None:
+        kwargs["ipsPath"] = job.ips
+    if job.get("bps", None) is not None:
+        kwargs["bpsPath"] = job.bps
+    try:
+        # keep the model's progress output from interleaving with the summary
+        with contextlib.redirect_stdout(sys.stderr):
+            gb, j = loadInputs(job.base, job.get("hack", None))
+            report = compileHack(gb, j, job.get("out", None), **kwargs)
+    except Exception as e:
+        report = model.JSONDict(success=False, errors=[str(e)], regions=model.JSONDict(), outputs=[])
+    report.name = job.name
+    report.base = job.base
+    report.hack = job.get("hack", None)
+    return report
+
+def runBatch(args):
+    jobs = loadManifest(args.batch)
+    kwargs = getSaveOptions(args)
+    # the jobs themselves are the unit of parallelism
+    kwargs.pop("parallel", None)
+    kwargs.pop("debugDir", None)
+    
+    def getJobOptions(i):
+        if args.debug_dir is None:
+            return kwargs
+        # (the name comes from the manifest, so it mustn't be able to lead out of the debug directory)
+        name = re.sub(r"[^\w.-]", "_", str(jobs[i].name))
+        return dict(kwargs, debugDir=os.path.join(args.debug_dir, f"{i:03d}-{name}"))
+    
+    workers = min(args.jobs or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        reports = [runBatchJob(job, getJobOptions(i)) for i, job in enumerate(jobs)]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            # grouped by base rom, so that each worker tends to see few distinct base roms
+            order = sorted(range(len(jobs)), key=lambda i: jobs[i].base)
+            futures = {i: executor.submit(runBatchJob, jobs[i], getJobOptions(i)) for i in order}
+            reports = [futures[i].result() for i in range(len(jobs))]
+    
+    return model.JSONDict(
+        success=all(report.success for report in reports),
+        jobs=reports,
+    )
+
+def printBatchReport(batch, quiet=False):
+    for report in batch.jobs:
+        if not quiet:
+            worst = max([(region.used or 0) / max(region.max, 1) for region in report.regions.values()], default=0)
+            status = "ok" if report.success else f"{len(report.errors)} error(s)"
+            print(f"{report.name:<32} {status:<12} fullest region {100 * worst:5.1f}%")
+        for error in report.errors:
+            print(f"ERROR: {report.name}:", error, file=sys.stderr)
+
+# yields once watching has started, then each time the file at path changes.
+# (so that changes made in between are seen, call next() once before first reading the file)
+def waitForChanges(path):
+    if watchdog is not None:
+        events = queue.Queue()
+        class Handler(watchdog.events.FileSystemEventHandler):
+            def on_any_event(self, event):
+                # (editors often save by renaming a temporary file over the original)
+                paths = [event.src_path, getattr(event, "dest_path", None)]
+                if path in [os.path.abspath(p) for p in paths if p]:
+                    events.put(event)
+        observer = watchdog.observers.Observer()
+        observer.schedule(Handler(), os.path.dirname(path))
+        observer.start()
+        try:
+            yield
+            while True:
+                events.get()
+                time.sleep(WATCH_SETTLE_TIME)
+                while not events.empty():
+                    events.get()
+                yield
+        finally:
+            observer.stop()
+    else:
+        def getStamp():
+            try:
+                st = os.stat(path)
+                return (st.st_mtime, st.st_size)
+            except OSError:
+                return None
+        stamp = getStamp()
+        yield
+        while True:
+            time.sleep(WATCH_POLL_INTERVAL)
+            newstamp = getStamp()
+            if newstamp != stamp:
+                time.sleep(WATCH_SETTLE_TIME)
+                stamp = getStamp()
+                yield
+
+# a hash of each sublevel's data (and of each level's data other than its sublevels), for reporting what changed
+def getHackSignatures(j):
+    def digest(data):
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).digest()
+    signatures = dict()
+    for level, jl in enumerate(j.get("levels", [])):
+        for sublevel, jsl in enumerate(jl.get("sublevels", [])):
+            signatures[f"{jl.get('name', level)}-{sublevel+1}"] = digest(jsl)
+        signatures[jl.get("name", str(level))] = digest({key: value for key, value in jl.items() if key != "sublevels"})
+    signatures["(global)"] = digest({key: value for key, value in j.items() if key != "levels"})
+    return signatures
+
+# recompiles the whole hack each time it changes. The only work skipped is the layout packets of
+# sublevels whose layout didn't change (see model.SaveContext.compileCache); the signatures of what
+# changed are just reported. Outputs are only replaced if they change.
+# with --report -, each compile's report goes to stdout, and everything else to stderr.
+def watch(args):
+    status = sys.stderr if args.report == "-" else sys.stdout
+    kwargs = getSaveOptions(args)
+    kwargs["compileCache"] = dict()
+    signatures = dict()
+    hackPath = os.path.abspath(args.hack)
+    
+    print(f"watching {args.hack} ({'watchdog' if watchdog is not None else 'polling'}); ctrl+c to stop", file=status)
+    changes = waitForChanges(hackPath)
+    next(changes)
+    while True:
+        model.trimCompileCache(kwargs["compileCache"])
+        try:
+            gb, j = loadInputs(args.base, args.hack)
+        except Exception as e:
+            # e.g. caught the file halfway through being written; there'll be another change
+            print(f"ERROR: {e}", file=sys.stderr)
+        else:
+            newSignatures = getHackSignatures(j)
+            changed = [key for key, signature in newSignatures.items() if signatures.get(key, None) != signature]
+            signatures = newSignatures
+            t = time.monotonic()
+            with contextlib.redirect_stdout(sys.stderr if args.quiet else status):
+                report = compileHack(gb, j, args.out, **kwargs)
+            t = time.monotonic() - t
+            if len(changed) == len(signatures):
+                summary = "everything"
+            elif len(changed) > 8:
+                summary = f"{len(changed)} levels/sublevels"
+            else:
+                summary = ", ".join(changed) or "nothing"
+            print(f"[{time.strftime('%H:%M:%S')}] compiled in {t:.2f}s ({'ok' if report.success else f'{len(report.errors)} error(s)'}); changed: {summary}", file=status)
+            printReport(report, True)
+            if args.report is not None:
+                try:
+                    writeReport(report, args.report)
+                    sys.stdout.flush()
+                except OSError as e:
+                    print(f"ERROR: writing report to {args.report}: {e}", file=sys.stderr)
+        next(changes)
+
+def main(argv):
+    args = parseArgs(argv)
+    if args.batch is not None:
+        try:
+            batch = runBatch(args)
+        except Exception as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+            return EXIT_USAGE
+        printBatchReport(batch, args.quiet or args.report == "-")
+        if args.report is not None:
+            try:
+                writeReport(batch, args.report)
+            except OSError as e:
+                print(f"ERROR: writing report to {args.report}: {e}", file=sys.stderr)
+                return EXIT_ERRORS
+        return EXIT_OK if batch.success else EXIT_ERRORS
+    
+    if args.base is None:
+        print("one of --base or --batch is required", file=sys.stderr)
+        return EXIT_USAGE
+    if args.out is None and args.ips is None and args.bps is None and args.report is None:
+        print("nothing to do: provide at least one of --out, --ips, --bps, --report", file=sys.stderr)
+        return EXIT_USAGE
+
+    if args.watch:
+        if args.hack is None:
+            print("--watch requires --hack", file=sys.stderr)
+            return EXIT_USAGE
+        try:
+            watch(args)
+        except KeyboardInterrupt:
+            pass
+        return EXIT_OK
+
+    report = None
+    if args.daemon is not None:
+        try:
+            report = compileWithDaemon(args)
+        except OSError as e:
+            print(f"{e}; compiling locally", file=sys.stderr)
+        except Exception as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+            return EXIT_USAGE
+    
+    if report is None:
+        try:
+            gb, j = loadInputs(args.base, args.hack)
+        except Exception as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+            return EXIT_USAGE
+
+        if args.report == "-":
+            # keep stdout clean for the report
+            with contextlib.redirect_stdout(sys.stderr):
+                report = compileHack(gb, j, args.out, **getSaveOptions(args))
+        else:
+            report = compileHack(gb, j, args.out, **getSaveOptions(args))
+    printReport(report, args.quiet or args.report == "-")
+    if args.report is not None:
+        try:
+            writeReport(report, args.report)
+        except OSError as e:
+            print(f"ERROR: writing report to {args.report}: {e}", file=sys.stderr)
+            return EXIT_ERRORS
+
+    return EXIT_OK if report.success else EXIT_ERRORS
+
+if __name__ == "__main__":
+    # needed for --parallel in frozen (pyinstaller) builds
+    multiprocessing.freeze_support()
+    sys.exit(main(sys.argv[1:]))
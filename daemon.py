@@ -0,0 +1,220 @@
+# compile daemon: keeps base roms and per-sublevel compile results in memory between requests,
+# so that cli.py (--daemon), the editor and other scripts can compile without a cold start.
+#
+# listens on a unix socket (a named pipe on windows). The connection is authenticated with
+# a random key which the daemon writes to a file only the current user can read (see getKeyPath).
+# each message is a json object; every request gets exactly one response.
+#
+# requests:
+#   {"op": "ping"}
+#   {"op": "compile", "base": path, "hack": path, "out"/"ips"/"bps": path, "options": {...}}
+#       options are passed on to saveRom (e.g. profile, packBudget, exactCoverBudget).
+#       instead of "hack", the hack data itself can be sent as "j". Without either, the base rom's own data is used.
+#       -> {"report": ...} (see cli.compileHack)
+#   {"op": "validate", "base": ..., "hack"/"j": ...}
+#       compiles without writing anything (options which would write files are ignored)
+#       -> {"report": ..., "problems": [{message, level, sublevel, x, y}, ...]}
+#       (problems are those model.validateHack can place in the hack; x and y may be null)
+#   {"op": "render", "base": ..., "hack"/"j": ..., "level": int, "sublevel": int}
+#       -> {"layout": 16x16 remapped screen layout (x-major), "screens": chunk indices (20 per screen) of each unique screen}
+#   {"op": "shutdown"}
+# responses have "ok": true, or "ok": false and "error": message.
+
+import sys
+import os
+import json
+import argparse
+import contextlib
+import secrets
+import tempfile
+import threading
+import traceback
+from multiprocessing.connection import Listener, Client
+import model
+import cli
+
+def getDefaultAddress():
+    if sys.platform == "win32":
+        return r"\\.\pipe\revedit"
+    return os.path.join(tempfile.gettempdir(), f"revedit-{os.getuid()}.sock")
+
+def getKeyPath(address):
+    if sys.platform == "win32":
+        return os.path.join(tempfile.gettempdir(), "revedit-daemon.key")
+    return address + ".key"
+
+def readKey(address):
+    with open(getKeyPath(address), "rb") as f:
+        return f.read()
+
+def sendMessage(conn, message):
+    conn.send_bytes(json.dumps(message).encode("utf-8"))
+
+def recvMessage(conn):
+    return json.loads(conn.recv_bytes().decode("utf-8"), object_hook=model.JSONDict)
+
+class Daemon:
+    def __init__(self, address):
+        self.address = address
+        # rom and the compile are not thread safe, so requests are handled one at a time.
+        self.lock = threading.Lock()
+        self.compileCache = dict()
+        self.key = secrets.token_bytes(32)
+        self.running = True
+        self.requests = 0
+
+    # returns (gb, j) for the request (see cli.loadInputs)
+    def getInputs(self, request):
+        if request.get("j", None) is not None:
+            gb, _ = cli.getBaseRom(request.base)
+            return gb, request.j
+        return cli.loadInputs(request.base, request.get("hack", None))
+
+    # write: whether the request may write files (only compile requests do)
+    def getOptions(self, request, write=False):
+        kwargs = dict(request.get("options", None) or {})
+        # the daemon's own cache; workers wouldn't share it
+        kwargs.pop("parallel", None)
+        kwargs.pop("executor", None)
+        if not write:
+            for option in ["ipsPath", "bpsPath", "debugDir"]:
+                kwargs.pop(option, None)
+        model.trimCompileCache(self.compileCache)
+        kwargs["compileCache"] = self.compileCache
+        return kwargs
+
+    def opPing(self, request):
+        return model.JSONDict(version=model.VERSION_NAME, requests=self.requests, compileCache=len(self.compileCache))
+
+    def opCompile(self, request):
+        gb, j = self.getInputs(request)
+        kwargs = self.getOptions(request, True)
+        for key, option in [("ips", "ipsPath"), ("bps", "bpsPath")]:
+            if request.get(key, None) is not None:
+                kwargs[option] = request[key]
+        return model.JSONDict(report=cli.compileHack(gb, j, request.get("out", None), **kwargs))
+
+    def opValidate(self, request):
+        gb, j = self.getInputs(request)
+        return model.JSONDict(
+            report=cli.compileHack(gb, j, None, **self.getOptions(request)),
+            problems=model.validateHack(j),
+        )
+
+    def opRender(self, request):
+        gb, j = self.getInputs(request)
+        level, sublevel = request.level, request.sublevel
+        ctx = model.SaveContext(gb, j)
+        model.constructScreenRemapping(ctx)
+        return model.JSONDict(
+            layout=model.constructRemappedLayout(ctx, level, sublevel),
+            screens=[
+                model.flatten(ctx.getUniqueScreenOriginalScreen(level, sublevel, uscreen)[1].data)
+                for uscreen in range(len(ctx.uniqueScreens[(level, sublevel)]))
+            ],
+            errors=ctx.errors,
+        )
+
+    def opShutdown(self, request):
+        self.running = False
+        return model.JSONDict()
+
+    def handle(self, request):
+        ops = {
+            "ping": self.opPing,
+            "compile": self.opCompile,
+            "validate": self.opValidate,
+            "render": self.opRender,
+            "shutdown": self.opShutdown,
+        }
+        if not isinstance(request, dict) or request.get("op", None) not in ops:
+            return model.JSONDict(ok=False, error=f"unknown request: {request.get('op', None) if isinstance(request, dict) else request}")
+        try:
+            with self.lock:
+                self.requests += 1
+                # progress output from the model goes to the daemon's stderr, never to the client
+                with contextlib.redirect_stdout(sys.stderr):
+                    response = ops[request.op](request)
+            response.ok = True
+            return response
+        except Exception as e:
+            traceback.print_exc()
+            return model.JSONDict(ok=False, error=str(e))
+
+    def serveConnection(self, conn):
+        try:
+            while self.running:
+                sendMessage(conn, self.handle(recvMessage(conn)))
+            # wake up the listener so that it sees it should stop
+            Client(self.address, authkey=self.key).close()
+        except (EOFError, OSError):
+            pass
+        except ValueError as e:
+            # not json
+            print(f"bad message: {e}", file=sys.stderr)
+        finally:
+            conn.close()
+
+    def serve(self):
+        keyPath = getKeyPath(self.address)
+        fd = os.open(keyPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.key)
+        if sys.platform != "win32" and os.path.exists(self.address):
+            # left over from a daemon that didn't shut down cleanly
+            os.remove(self.address)
+        listener = Listener(self.address, authkey=self.key)
+        print(f"listening on {self.address}", file=sys.stderr)
+        try:
+            while self.running:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    # e.g. a client with the wrong key
+                    print(f"rejected connection: {e}", file=sys.stderr)
+                    continue
+                if not self.running:
+                    conn.close()
+                    break
+                thread = threading.Thread(target=self.serveConnection, args=(conn,), daemon=True)
+                thread.start()
+        finally:
+            listener.close()
+            if os.path.exists(keyPath):
+                os.remove(keyPath)
+
+# sends one request to a running daemon and returns its response.
+# raises an OSError if no daemon is listening at the address.
+def request(message, address=None):
+    address = address or getDefaultAddress()
+    try:
+        key = readKey(address)
+    except OSError:
+        raise ConnectionRefusedError(f"no daemon running at {address}")
+    with Client(address, authkey=key) as conn:
+        sendMessage(conn, message)
+        return recvMessage(conn)
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]),
+        description=f"RevEdit {model.VERSION_NAME} compile daemon."
+    )
+    parser.add_argument("--address", default=None, help=f"socket (or pipe) to listen on (default: {getDefaultAddress()})")
+    parser.add_argument("--stop", action="store_true", help="stop the daemon listening at the address")
+    args = parser.parse_args(argv)
+    address = args.address or getDefaultAddress()
+
+    if args.stop:
+        try:
+            request(model.JSONDict(op="shutdown"), address)
+        except OSError as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+            return 1
+        return 0
+
+    Daemon(address).serve()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
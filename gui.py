@@ -8,7 +8,7 @@ from PySide6.QtWidgets import \
     QComboBox, QGridLayout, QScrollArea, QListWidget, QListWidgetItem, \
     QAbstractItemView, QSpinBox, QRadioButton, QButtonGroup, QPushButton, \
     QCheckBox, QFrame, QStyle, QFileDialog, QMessageBox, QDialog, QLineEdit
-from PySide6.QtGui import QColor, QAction, QIcon, QPainter, QPen, QFont, QFontMetrics, QImage, QKeySequence, QPolygon
+from PySide6.QtGui import QColor, QBrush, QAction, QIcon, QPainter, QPen, QFont, QFontMetrics, QImage, QKeySequence, QPolygon
 from PySide6.QtCore import Qt, QAbstractListModel, QSize, QRect, QEvent, Slot, QPoint, QTimer, Signal
 import functools
 import copy
@@ -162,11 +162,17 @@ class UsageBar(QWidget):
         super().__init__()
         self.used = None
         self.max = None
+        # estimated usage since the last compile (see MainWindow.updateUsageEstimates)
+        self.estimate = None
         self.label = label
         self.shortname = shortname
         self.start = None
         self.end = None
         self.subranges = []
+        # what produced each byte of the last compile (see model.ProvenanceIndex)
+        self.provenance = None
+        # called with a source when the bar is clicked
+        self.onSourceClicked = None
         self.setMinimumHeight(15)
         self.setMaximumHeight(40)
         self.setAttribute(Qt.WidgetAttribute.WA_Hover)
@@ -178,22 +184,33 @@ class UsageBar(QWidget):
         cols = [0xFF * brightness + (0xFF * (1-brightness)) * col for col in cols]
         return QColor(*cols, 0xFF * alpha)
         
+    # the sources of the byte under the mouse, most specific first
+    def getSourcesAt(self, x):
+        if self.provenance is None or self.max is None:
+            return []
+        addr = self.start + math.floor(x / self.width() * self.max)
+        return self.provenance.lookup(self.bank, addr)
+    
     def mouseMoveEvent(self, event):
-        hoverP = event.position().x() / self.width()
         label = (self.shortname + " ") if self.shortname is not None else ""
         text = f"{label}{self.bank:X}:[${self.start:04X}–${self.end:04X}]"
-        for key, subrange in self.subranges.items():
-            p0 = (subrange.start - self.start) / self.max
-            p1 = (subrange.end - self.start) / self.max
-            if hoverP >= p0 and hoverP < p1:
-                b = subrange.end - subrange.start
-                text += f" | {key} [${subrange.start:04X}–${subrange.end:04X}] = ${b:X} {plural(b, 'byte')}"
-                if "units" in self.region and b % self.region.unitdiv == 0:
-                    u = b // self.region.unitdiv
-                    text += f" ({u} {plural(u, *self.region.units)})"
-                break
+        sources = self.getSourcesAt(event.position().x())
+        if len(sources) > 0:
+            source = sources[0]
+            b = source.end - source.start
+            text += f" | {source.label} [${source.start:04X}–${source.end:04X}] = ${b:X} {plural(b, 'byte')}"
+            if "units" in self.region and b % self.region.unitdiv == 0:
+                u = b // self.region.unitdiv
+                text += f" ({u} {plural(u, *self.region.units)})"
+            for source in sources[1:]:
+                text += f"\nin {source.label} [${source.start:04X}–${source.end:04X}]"
         self.setToolTip(text)
     
+    def mousePressEvent(self, event):
+        sources = self.getSourcesAt(event.position().x())
+        if len(sources) > 0 and self.onSourceClicked is not None:
+            self.onSourceClicked(sources[0])
+    
     def paintEvent(self, event):
         painter = QPainter(self)
         w, h = self.width(), self.height()
@@ -211,6 +228,12 @@ class UsageBar(QWidget):
                 color = QColor(0x30, 0x33, 0xE0)
             painter.fillRect(0, 0, w*p, h, color)
             text += f"{self.used:X}/{self.max:X} ({self.used/self.max*100:2.2f}%)"
+            if self.estimate is not None and self.estimate != self.used:
+                # the change since the last compile, hatched
+                pe = self.estimate/self.max
+                color = Qt.red if pe > 1 else QColor(0x30, 0x33, 0xE0)
+                painter.fillRect(QRect(math.floor(w*min(p, pe)), 0, math.ceil(w*abs(pe - p)), h), QBrush(color, Qt.BDiagPattern))
+                text += f" → ~{self.estimate:X} ({pe*100:2.2f}%)"
         else:
             text += "~"
             pass
@@ -234,6 +257,20 @@ class UsageBar(QWidget):
         painter.drawText(QRect(0, 0, w, h), Qt.AlignCenter, text)
         
 
+# text summary of a compile profile (see model.Profile.report)
+def formatProfile(profile):
+    lines = [f"Compile time: {profile.total*1000:.1f} ms"]
+    for phase in sorted(profile.phases, key=lambda phase: -phase.time):
+        lines.append(f"  {phase.name:<44} {phase.time*1000:8.1f} ms  x{phase.calls}")
+    lines.append("Bytes written:")
+    for name, region in profile.regions.items():
+        if region.written > 0:
+            lines.append(f"  {name:<44} {region.written:8}")
+    lines.append("Counters:")
+    for name, n in profile.counters.items():
+        lines.append(f"  {name:<44} {n:8}")
+    return "\n".join(lines)
+
 # Undoable Action
 class UAction:
     def __init__(self, do, undo, restorecontext=None, refreshcontext=None):
@@ -294,72 +331,95 @@ class UndoBuffer:
         self.buff[-1].refreshcontext(self.app)
         self.cb("push")
 
+# a byte with each bit (msb first) spread over 8 bytes, each value if the bit is set and 0 otherwise
+def makeBitplaneTable(value):
+    return [bytes(value if (b >> (7 - x)) & 1 else 0 for x in range(8)) for b in range(0x100)]
+
+BITPLANE_LO = makeBitplaneTable(1)
+BITPLANE_HI = makeBitplaneTable(2)
+
+# decodes 2bpp tile data (pairs of bitplane bytes, one pair per row) into one byte per pixel, 8 pixels per row.
+# the two bitplanes are spread out a whole buffer at a time, then combined as two big ints (no carries, as they never overlap).
+def decode2bpp(data):
+    lo = b"".join(map(BITPLANE_LO.__getitem__, data[0::2]))
+    hi = b"".join(map(BITPLANE_HI.__getitem__, data[1::2]))
+    return (int.from_bytes(lo, "big") | int.from_bytes(hi, "big")).to_bytes(len(lo), "big")
+
+VRAM_TILES = 0x200
+# pixel value for tiles that haven't been loaded (see VRam.clearVram)
+VRAM_UNLOADED = 4
+
 class VRam:
     def __init__(self, j, nes):
         self.j = j
         self.nes = nes
-        self.tileset = [QImage(QSize(8, 8), QImage.Format_RGB32) for i in range(0x200)]
-        self.spritetileset = [[QImage(QSize(8, 16), QImage.Format_ARGB32) for i in range(0x200)] for flip in range(4)]
+        # one byte per pixel (see decode2bpp), with the tiles stacked top to bottom, 8 pixels wide:
+        # 8x8 background tiles, and 8x16 sprite tiles (as sprites use 8x16 mode) for each tile index.
+        self.pixels = bytearray([VRAM_UNLOADED]) * (VRAM_TILES * 64)
+        self.spritePixels = bytearray([VRAM_UNLOADED]) * (VRAM_TILES * 128)
+        self.colorTable = [QColor(*color).rgba() for color in rom.PALETTE] + [QColor(0xff, 0x00, 0xff).rgba()]
+        self.spriteColorTable = [QColor(0, 0, 0, 0).rgba()] + self.colorTable[1:]
+        # the above as indexed images (see buildAtlases); tiles are drawn from sub-rectangles of them.
+        self.atlas = None
+        self.spriteAtlases = None # one per flip
         self.defimg = QImage(QSize(8, 8), QImage.Format_RGB32)
         self.defimg.fill(QColor(0xff, 0x00, 0xff))
         self.cached_vram_descriptor = None
-        
+        self.buildAtlases()
+    
+    # returns (image, source rect)
     def getVramBGTile(self, tileidx):
-        if tileidx > 0x80:
-            return self.tileset[tileidx]
-        return self.tileset[0x100 + tileidx]
+        if tileidx <= 0x80:
+            tileidx += 0x100
+        return self.atlas, QRect(0, tileidx * 8, 8, 8)
     
+    # returns (image, source rect)
     def getVramSpriteTile(self, tileidx, flip=0):
-        return self.spritetileset[flip][tileidx]
-        
-    def loadVramTile(self, destaddr, srcaddr, srcbank, loadSprites):
-        # create an 8x8 QImage with Format_RGB32
-        if loadSprites:
-            aimage = [QImage(QSize(8, 16), QImage.Format_ARGB32) for i in range(4)]
-        else:
-            image = QImage(QSize(8, 8), QImage.Format_RGB32)
-        
-        destaddr -= 0x8000
-        destaddr //= 0x10
-        
-        def readbyte(srcbank, addr):
-            return self.nes[0x4000 * srcbank + (addr)%0x4000]
-
-        for y in range(16):
-            b1 = readbyte(srcbank, srcaddr + y*2)
-            b2 = readbyte(srcbank, srcaddr + y*2 + 1)
-            for x in range(8):
-                c1 = (b1 >> (7-x)) & 1
-                c2 = (b2 >> (7-x)) & 1
-                if y < 8 and not loadSprites:
-                    image.setPixelColor(x, y, QColor(*rom.PALETTE[c1 + c2*2]))
-                elif loadSprites:
-                    for i in range(4):
-                        _x = x if (i % 2 == 0) else 7-x
-                        _y = y if (i // 2 == 0) else 15-y
-                        aimage[i].setPixelColor(_x, _y, QColor(*rom.PALETTE[c1 + c2*2], 0 if c1 + c2*2 == 0 else 255))
-        
+        if flip & 2:
+            # (mirrored vertically, the tiles are in reverse order too)
+            tileidx = VRAM_TILES - 1 - tileidx
+        return self.spriteAtlases[flip], QRect(0, tileidx * 16, 8, 16)
+    
+    def buildAtlases(self):
+        # (copied, so that the images don't refer to the buffers)
+        self.atlas = QImage(bytes(self.pixels), 8, VRAM_TILES * 8, 8, QImage.Format_Indexed8).copy()
+        self.atlas.setColorTable(self.colorTable)
+        sprites = QImage(bytes(self.spritePixels), 8, VRAM_TILES * 16, 8, QImage.Format_Indexed8).copy()
+        sprites.setColorTable(self.spriteColorTable)
+        self.spriteAtlases = [sprites.mirrored(flip & 1 != 0, flip & 2 != 0) for flip in range(4)]
+    
+    # reads from the rom, wrapping around within the bank
+    def readBytes(self, srcbank, addr, length):
+        data = b""
+        while len(data) < length:
+            start = 0x4000 * srcbank + (addr + len(data)) % 0x4000
+            data += self.nes[start:min(start + length - len(data), 0x4000 * (srcbank + 1))]
+        return data
+    
+    # loads count consecutive tiles
+    def loadVramTiles(self, destaddr, srcaddr, srcbank, count, loadSprites):
+        tileidx = (destaddr - 0x8000) // 0x10
+        count = min(count, VRAM_TILES - tileidx)
+        if count <= 0:
+            return
         if loadSprites:
-            for i in range(4):
-                self.spritetileset[i][destaddr] = aimage[i]
+            # each 8x16 sprite tile is read as its own 32 bytes, so it runs on into the next tile
+            pixels = decode2bpp(self.readBytes(srcbank, srcaddr, count * 0x10 + 0x10))
+            for i in range(count):
+                self.spritePixels[(tileidx + i) * 128:(tileidx + i + 1) * 128] = pixels[i * 64:i * 64 + 128]
         else:
-            self.tileset[destaddr] = image
+            self.pixels[tileidx * 64:(tileidx + count) * 64] = decode2bpp(self.readBytes(srcbank, srcaddr, count * 0x10))
         
     def getDefaultImage(self):
         return self.defimg
         
     def clearVram(self):
-        for i in range(0x200):
-            self.tileset[i] = self.getDefaultImage()
-            for flip in range(4):
-                self.spritetileset[flip][i] = self.getDefaultImage()
+        self.pixels[:] = bytearray([VRAM_UNLOADED]) * len(self.pixels)
+        self.spritePixels[:] = bytearray([VRAM_UNLOADED]) * len(self.spritePixels)
         
     def loadVramFromBuffer(self, buff, loadSprites):
         for entry in buff:
-            destaddr = entry.destaddr
-            srcaddr = entry.srcaddr
-            for i in range(entry.destlen // 0x10):
-                self.loadVramTile(destaddr + i * 0x10, srcaddr + i * 0x10, entry.srcbank, loadSprites)
+            self.loadVramTiles(entry.destaddr, entry.srcaddr, entry.srcbank, entry.destlen // 0x10, loadSprites)
         
     def loadVramForStage(self, level, sublevel=0, **kwargs):
         loadSprites = kwargs.get("load_sprites", False)
@@ -371,25 +431,25 @@ class VRam:
         
         # not sure what loads tile 0x100 to white (maybe nothing)
         # but it should be white.
-        self.tileset[0x100] = QImage(QSize(8, 8), QImage.Format_RGB32)
-        self.tileset[0x100].fill(Qt.white)
+        self.pixels[0x100 * 64:0x101 * 64] = bytes(64) # (colour 0)
         
         self.loadVramFromBuffer(self.j.tileset_common, loadSprites)
         self.loadVramFromBuffer(self.j.levels[level].tileset, loadSprites)
         for jsl in self.j.levels[level].sublevels[1:sublevel+1]:
             for tilePatch in jsl.tilePatches:
-                for i in range(tilePatch.count):
-                    self.loadVramTile(tilePatch.dst + 0x10 * i, tilePatch.source + i * 0x10, tilePatch.bank, loadSprites)
+                self.loadVramTiles(tilePatch.dst, tilePatch.source, tilePatch.bank, tilePatch.count, loadSprites)
+        self.buildAtlases()
 
 def paintTile(painter, vram, x, y, tileidx, scale):
     x2 = x + scale * 8
     y2 = y + scale * 8
     if tileidx >= 0:
-        img = vram.getVramBGTile(tileidx)
+        img, src = vram.getVramBGTile(tileidx)
     else:
         img = vram.getDefaultImage()
+        src = img.rect()
     f = math.floor
-    painter.drawImage(QRect(f(x), f(y), f(x2 - x + 1), f(y2 - y + 1)), img)
+    painter.drawImage(QRect(f(x), f(y), f(x2 - x + 1), f(y2 - y + 1)), img, src)
 
 class NonScrollableComboBox(QComboBox):
     def wheelEvent(self, *args, **kwargs):
@@ -687,10 +747,10 @@ class SpriteView(QWidget):
         
         for tile in self.tiles:
             flags = 0 if not "flags" in tile else tile.flags
-            img = self.app.vram.getVramSpriteTile(tile.tidx, (flags >> 5) & 3)
+            img, src = self.app.vram.getVramSpriteTile(tile.tidx, (flags >> 5) & 3)
             painter.drawImage(
                 QRect(scale*(tile.xoff-bbx0), scale*(tile.yoff-bby0), 8*scale, 16*scale),
-                img
+                img, src
             )
 
 class ScreenWidget(QWidget):
@@ -851,6 +911,9 @@ class RoomLayWidget(QWidget):
         super().__init__(parent)
         self.gridSize = 16  # the number of squares in each row/column
         self.app = parent
+        # (j, level, sublevel, graph, problems) as of the last edit (see MainWindow.updateProblems),
+        # so that repaints don't have to check the sublevel over again.
+        self.sublevelState = None
         
     def resizeEvent(self, event):
         self.update()
@@ -882,6 +945,14 @@ class RoomLayWidget(QWidget):
     def getSquareSize(self):
         return min(self.width(), self.height()) // self.gridSize
 
+    # returns graph, problems for the sublevel
+    def getSublevelState(self, level, sublevel):
+        state = self.sublevelState
+        if state is None or state[0] is not self.app.j or state[1:3] != (level, sublevel):
+            state = (self.app.j, level, sublevel, model.getSublevelGraph(self.app.j, level, sublevel), model.validateSublevel(self.app.j, level, sublevel))
+            self.sublevelState = state
+        return state[3], state[4]
+    
     def paintEvent(self, event):
         painter = QPainter(self)
         painter.setRenderHint(QPainter.Antialiasing)
@@ -904,12 +975,13 @@ class RoomLayWidget(QWidget):
         squareSize = self.getSquareSize()
         
         exits = []
-        enterable = model.getEnterabilityLayout(self.app.j, level, sublevel)
+        graph, problems = self.getSublevelState(level, sublevel)
+        enterable = graph.enterable
 
         for i in range(self.gridSize):
             for j in range(self.gridSize):
                 l = jlayout[i][j]
-                for exit in model.getScreenExitDoor(self.app.j, level, sublevel, l & 0x0F):
+                for exit in graph.doors[l & 0x0F]:
                     exits.append((i, j, exit))
                 text = f"{l:02X}"
                 x = i * squareSize
@@ -972,6 +1044,15 @@ class RoomLayWidget(QWidget):
                     painter.setPen(Qt.black)
                     painter.drawText(x + squareSize/2 - 6, y + squareSize/2 + 4, text)
         
+        # outline screens with problems (see model.validateSublevel)
+        problemPen = QPen(QColor(0xE0, 0x20, 0x20))
+        problemPen.setWidth(3)
+        painter.setPen(problemPen)
+        painter.setBrush(Qt.NoBrush)
+        for problem in problems:
+            if problem.x is not None:
+                painter.drawRect(problem.x * squareSize + 2, problem.y * squareSize + 2, squareSize - 4, squareSize - 4)
+        
         for i, j, dir in exits:
             x = squareSize * ((i + 1) if dir == 1 else i)
             x -= 0.1 * dir * squareSize
@@ -992,6 +1073,9 @@ class MainWindow(QMainWindow):
         model.addEmptyScreens(self.j)
         self.undoBuffer = UndoBuffer(self, self.onUndoBuffer)
         self.ioStore = dict()
+        # per-sublevel compile results, reused between compiles (see model.SaveContext).
+        # compiles run on copies of it (see getCompileCache), as the usage compile runs in its own thread.
+        self.compileCache = dict()
         self.vram = VRam(self.j, self.rom)
         self.config = {
             "emuPath": DEFAULT_EMUPATH
@@ -1007,6 +1091,7 @@ class MainWindow(QMainWindow):
         self.qcb_sprites = []
         self.screenGrids = []
         self.screenTabs = []
+        self.screenProblemLabels = []
         self.lastScreenTab = None
         self.chunkSelected = {}
         self.tileSelected = {}
@@ -1078,6 +1163,12 @@ class MainWindow(QMainWindow):
         self.actExport.triggered.connect(functools.partial(self.onFileIO, "rom", IO_SAVEAS))
         self.actExport.setShortcut(QKeySequence("ctrl+e"))
         
+        self.actExportIPS = QAction("Export &IPS Patch...", self)
+        self.actExportIPS.triggered.connect(functools.partial(self.onFileIO, "ips", IO_SAVEAS))
+        
+        self.actExportBPS = QAction("Export &BPS Patch...", self)
+        self.actExportBPS.triggered.connect(functools.partial(self.onFileIO, "bps", IO_SAVEAS))
+        
         self.actPlaytest = QAction("&Playtest...", self)
         self.actPlaytest.triggered.connect(self.onPlaytest)
         self.actPlaytest.setShortcut(QKeySequence("ctrl+p"))
@@ -1110,6 +1201,8 @@ class MainWindow(QMainWindow):
         file_menu.addSeparator()
         file_menu.addAction(self.actPlaytest)
         file_menu.addAction(self.actExport)
+        file_menu.addAction(self.actExportIPS)
+        file_menu.addAction(self.actExportBPS)
         
         edit_menu = menu.addMenu("&Edit")
         edit_menu.addAction(self.actUndo)
@@ -1228,9 +1321,12 @@ class MainWindow(QMainWindow):
         cvlay.addWidget(QWidget()) # padding
         hlay.addWidget(cvlayw)
         
+        self.layProblemsLabel = self.makeProblemsLabel()
+        
         self.layWidgets = [self.sublevelVerticalScrollingCheckbox, self.screenIDSelector, self.sublevelStartXBox, self.sublevelStartYBox, self.layoutScreenScrollButtonGroup, *self.layoutScreenScrollButtons]
         
         vlay.addLayout(hlay)
+        vlay.addWidget(self.layProblemsLabel)
     
     def defineScreenTab(self, tab):
         self.screenGrids.append(ScreenTileWidget(self, tab))
@@ -1242,6 +1338,8 @@ class MainWindow(QMainWindow):
         self.chunkSelectors.append(SelectorPanel(self, ChunkSelectorWidget))
         hlay.addWidget(self.chunkSelectors[-1])
         vlay.addLayout(hlay)
+        self.screenProblemLabels.append(self.makeProblemsLabel())
+        vlay.addWidget(self.screenProblemLabels[-1])
         
     def addRadioButtons(self, *labels, **kwargs):
         hlay = kwargs.get("layout", QHBoxLayout)()
@@ -1345,7 +1443,10 @@ class MainWindow(QMainWindow):
         self.prevUsageResult = None
         self.usageTab = tab
         self.usageCalcTime = 0
-        self.usageLock = threading.Lock()
+        # (reentrant, as the compile cache is also guarded by it; see getCompileCache)
+        self.usageLock = threading.RLock()
+        # shows the effect of edits made since the last compile, until the next one finishes
+        self.usageEstimator = model.UsageEstimator()
         
         # ms
         self.usageCallTimerInterval = 10
@@ -1367,6 +1468,15 @@ class MainWindow(QMainWindow):
         bars.setLayout(self.usageBarLayout)
         vlay.addWidget(bars)
         
+        # where compile time goes
+        self.usageProfileLabel = QLabel()
+        self.usageProfileLabel.setFont(QFont("Monospace"))
+        self.usageProfileLabel.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        profileScroll = QScrollArea(self)
+        profileScroll.setWidget(self.usageProfileLabel)
+        profileScroll.setWidgetResizable(True)
+        vlay.addWidget(profileScroll)
+        
         tab.setLayout(vlay)
         
         # usage calculation timer
@@ -1375,6 +1485,16 @@ class MainWindow(QMainWindow):
         timer.timeout.connect(self.updateUsage)
         timer.start(10)
     
+    # a copy of the compile cache for one compile to use and add to (see storeCompileCache)
+    def getCompileCache(self):
+        with self.usageLock:
+            model.trimCompileCache(self.compileCache)
+            return dict(self.compileCache)
+    
+    def storeCompileCache(self, compileCache):
+        with self.usageLock:
+            self.compileCache.update(compileCache)
+    
     def updateUsage(self, iterations=1):
         self.updateUsageLabel()
         
@@ -1385,8 +1505,15 @@ class MainWindow(QMainWindow):
                 self.usageDirty = False
                 self.usageCalc = 1
                 # note that no path is provided, so it won't save to disk.
+                j = copy.deepcopy(self.j)
+                estimator = self.usageEstimator
+                compileCache = self.getCompileCache()
                 def threadRoutine():
-                    regions, errors = model.saveRom(self.rom, copy.deepcopy(self.j))
+                    profile = model.Profile()
+                    provenance = model.ProvenanceIndex()
+                    regions, errors = model.saveRom(self.rom, j, profile=profile, compileCache=compileCache, provenance=provenance)
+                    self.storeCompileCache(compileCache)
+                    provenance.build()
                     regions.sort(key=lambda region: -region.max)
                     #print("locking...")
                     with self.usageLock:
@@ -1394,7 +1521,11 @@ class MainWindow(QMainWindow):
                         self.usageCalcTime = self.timeInSeconds()
                         self.usageResult = {
                             "regions": regions,
-                            "errors": errors
+                            "errors": errors,
+                            "profile": profile.result,
+                            "j": j,
+                            "estimator": estimator,
+                            "provenance": provenance,
                         }
                         self.usageCalc = None
                 threading.Thread(target=threadRoutine).start()
@@ -1731,6 +1862,7 @@ class MainWindow(QMainWindow):
                     self.usageBars.clear()
                     for region in regions:
                         usageBar = UsageBar(region.name, region.shortname)
+                        usageBar.onSourceClicked = self.gotoSource
                         self.usageBarLayout.addWidget(usageBar)
                         self.usageBars[region.name] = usageBar
                 for region in regions:
@@ -1742,7 +1874,14 @@ class MainWindow(QMainWindow):
                     self.usageBars[region.name].used = region.used
                     self.usageBars[region.name].max = region.max
                     self.usageBars[region.name].subranges = region.subranges
+                    self.usageBars[region.name].provenance = self.usageResult["provenance"]
                     self.usageBars[region.name].update()
+                self.usageProfileLabel.setText(formatProfile(self.usageResult["profile"]))
+                # start estimating from this compile, catching up on any edits made while it ran.
+                # (if a different hack was opened meanwhile, this is no longer the current estimator.)
+                self.usageResult["estimator"].reset(self.usageResult["j"], regions)
+                self.usageResult["estimator"].updateAll(self.j)
+                self.updateUsageEstimates()
             
             text = "Usage"
             icon = self.emptyIcon
@@ -1754,6 +1893,11 @@ class MainWindow(QMainWindow):
                 for error in self.usageResult["errors"]:
                     text += "\nERROR: " + error
                     icon = self.errorIcon
+                if self.usageDirty or self.usageCalc is not None:
+                    for name, usageBar in self.usageBars.items():
+                        if usageBar.estimate is not None and usageBar.max is not None and usageBar.estimate > usageBar.max:
+                            text += f"\nWARNING: region \"{name}\" is estimated to overflow (~{usageBar.estimate:X} > {usageBar.max:X} bytes)"
+                            icon = self.errorIcon
                 self.usageLabel.setText(text)
                 
             tabtext = "Usage"
@@ -1762,6 +1906,65 @@ class MainWindow(QMainWindow):
             self.tabs.setTabText(self.tabs.indexOf(self.usageTab), tabtext)
             self.tabs.setTabIcon(self.tabs.indexOf(self.usageTab), icon)
     
+    # shows whatever in the hack produced some part of the compiled rom (see model.ProvenanceIndex)
+    def gotoSource(self, source):
+        level = source.get("level", None)
+        if level is None or level == 0 or level >= len(self.j.levels):
+            return
+        if "chunk" in source:
+            self.setLevel(level-1)
+            self.setChunk(source.chunk)
+            self.tabs.setCurrentWidget(self.chunkEdit.restoreTab)
+        elif "sublevel" not in source:
+            self.setLevel(level-1)
+        elif "cat" in source:
+            self.restoreEntityContext(level, source.sublevel, source.screen)
+        elif "screen" in source:
+            self.setLevel(level-1)
+            self.setSublevel(source.sublevel)
+            self.setScreen(source.screen)
+            self.tabs.setCurrentWidget(self.screenTabs[0])
+        else:
+            self.restoreLayoutContext(level, source.sublevel)
+    
+    # shows the estimated usage on each bar (see model.UsageEstimator)
+    def updateUsageEstimates(self):
+        for name, usageBar in self.usageBars.items():
+            usageBar.estimate = self.usageEstimator.estimate(name)
+            usageBar.update()
+    
+    def makeProblemsLabel(self):
+        label = QLabel()
+        label.setStyleSheet("color: #C02020")
+        label.setWordWrap(True)
+        label.hide()
+        return label
+    
+    # shows the problems with the current sublevel, and with the current screen
+    def updateProblems(self):
+        MAXLINES = 6
+        def setProblems(label, problems):
+            messages = list(dict.fromkeys(problem.message for problem in problems))
+            if len(messages) > MAXLINES:
+                messages = messages[:MAXLINES - 1] + [f"...and {len(messages) - MAXLINES + 1} more."]
+            label.setText("\n".join(messages))
+            label.setVisible(len(messages) > 0)
+        
+        jl, jsl, js = self.getLevelJ()
+        level, sublevel, screen = self.getLevel()
+        problems = model.validateSublevel(self.j, level, sublevel)
+        self.layGrid.sublevelState = (self.j, level, sublevel, model.getSublevelGraph(self.j, level, sublevel), problems)
+        setProblems(self.layProblemsLabel, problems)
+        screenProblems = []
+        if self.sel_special_screen.get((level, sublevel), False) is False:
+            screenProblems = [
+                problem for problem in problems
+                if problem.x is not None and jsl.layout[problem.x][problem.y] != 0 and jsl.layout[problem.x][problem.y] & 0x0F == screen
+            ]
+        for label in self.screenProblemLabels:
+            setProblems(label, screenProblems)
+        self.layGrid.update()
+    
     def updateLay(self):
         jl, jsl, js = self.getLevelJ()
         level, sublevel, screen = self.getLevel()
@@ -1791,11 +1994,12 @@ class MainWindow(QMainWindow):
                 self.screenIDSelector.setCurrentIndex(0)
             else:
                 self.screenIDSelector.setCurrentIndex(s + 1)
+                graph = model.getSublevelGraph(self.j, level, sublevel)
                 if (x, y) == (jsl.startx, jsl.starty):
                     text += "\nSublevel entrance."
-                elif model.getScreenEnterable(self.j, level, sublevel, x, y):
+                elif model.getScreenEnterable(self.j, level, sublevel, x, y, graph):
                     text += "\nScreen is enterable."
-                exits = model.getScreenExitDoor(self.j, level, sublevel, s)
+                exits = graph.doors[s]
                 if -1 in exits and 1 in exits:
                     text += "\nDoors exit to left and right."
                 elif -1 in exits:
@@ -1819,7 +2023,7 @@ class MainWindow(QMainWindow):
                 button.setChecked(True)
                 
         self.screenLabel.setText(text)
-        self.layGrid.update()
+        self.updateProblems()
         for w in self.layWidgets:
             w.blockSignals(False)
     
@@ -1860,6 +2064,12 @@ class MainWindow(QMainWindow):
         
     def onUndoBuffer(self, kind):
         self.usageDirty = True
+        # (an undo or redo restores the context it was made in first, so this is where the edit was.)
+        level, sublevel, screen = self.getLevel()
+        if level != 0:
+            self.usageEstimator.update(self.j, level, sublevel)
+            self.updateUsageEstimates()
+        self.updateProblems()
         
     def undo(self):
         self.undoBuffer.undo()
@@ -2026,16 +2236,22 @@ class MainWindow(QMainWindow):
         
         DMESG = {
             "rom": f"{verb} a ROM file",
+            "ips": f"{verb} an IPS patch",
+            "bps": f"{verb} a BPS patch",
             "hack": f"{verb} a hack file"
         }
         
         DEXT = {
             "rom": ".gb",
+            "ips": ".ips",
+            "bps": ".bps",
             "hack": ".json",
         }
         
         DFILT = {
             "rom": "ROM files (*.gb *.gbc *.bin)",
+            "ips": "IPS patches (*.ips)",
+            "bps": "BPS patches (*.bps)",
             "hack": "Hack files (*.json)"
         }
         
@@ -2072,7 +2288,17 @@ class MainWindow(QMainWindow):
         if target == "rom":
             assert mode in [IO_SAVEAS, IO_SAVE]
             print(f"Exporting rom to {path}")
-            _, errors = model.saveRom(self.rom, self.j, path, **kwargs)
+            if debugDir is not None:
+                kwargs["debugDir"] = debugDir
+            kwargs["compileCache"] = self.getCompileCache()
+            if profilePath is not None:
+                profile = model.Profile()
+                _, errors = model.saveRom(self.rom, self.j, path, profile=profile, **kwargs)
+                with open(profilePath, "w") as f:
+                    json.dump(profile.result, f, indent=4)
+            else:
+                _, errors = model.saveRom(self.rom, self.j, path, **kwargs)
+            self.storeCompileCache(kwargs["compileCache"])
             print("Done.")
             
             if len(errors) > 0:
@@ -2086,6 +2312,26 @@ class MainWindow(QMainWindow):
                     result
                 )
                 return -1
+        
+        elif target in ["ips", "bps"]:
+            assert mode in [IO_SAVEAS, IO_SAVE]
+            print(f"Exporting {target} patch to {path}")
+            compileCache = self.getCompileCache()
+            _, errors = model.saveRom(self.rom, self.j, None, compileCache=compileCache, **{target + "Path": path})
+            self.storeCompileCache(compileCache)
+            print("Done.")
+            
+            if len(errors) > 0:
+                result = ""
+                for error in errors:
+                    result += error + "\n"
+                    print("ERROR:", error)
+                QMessageBox.information(
+                    self,
+                    'Error exporting patch',
+                    result
+                )
+                return -1
                 
         elif target == "hack":
             if mode == IO_OPEN:
@@ -2093,6 +2339,9 @@ class MainWindow(QMainWindow):
                     self.undoBuffer.clear()
                     j = json.load(f, object_hook=model.JSONDict)
                     self.j = j
+                    self.usageEstimator = model.UsageEstimator()
+                    self.usageDirty = True
+                    self.updateUsageEstimates()
             elif mode in [IO_SAVE, IO_SAVEAS]:
                 with open(path, "w") as f:
                     json.dump(self.j, f, ensure_ascii=False, indent=4)
@@ -2114,13 +2363,17 @@ class MainWindow(QMainWindow):
 
 if "--help" in sys.argv or "-h" in sys.argv:
     print(f"{APPNAME}")
-    print(f"{sys.argv[0]} [--base=/path/to/base.gb]")
+    print(f"{sys.argv[0]} [--base=/path/to/base.gb] [--profile=/path/to/profile.json] [--debug-dir=/path/to/dir]")
+    print("  --profile: write a compile profile (as json) to the given path whenever a rom is exported")
+    print("  --debug-dir: write region dumps, subrange maps and remap tables to the given directory whenever a rom is exported")
     sys.exit(0)
 
 app = QApplication(sys.argv)
 
 base = None
 multibase = False
+profilePath = None
+debugDir = None
 
 for s in sys.argv:
     if s.startswith("--base="):
@@ -2128,6 +2381,10 @@ for s in sys.argv:
         if not os.path.exists(base):
             print(f"not found: {base}")
             sys.exit(1)
+    if s.startswith("--profile="):
+        profilePath = s[10:]
+    if s.startswith("--debug-dir="):
+        debugDir = s[12:]
 
 if base is None:            
     for candidate in ["base.gb", "base-us.gb", "base-kgbc4eu.gb", "base-jp.gb"]:
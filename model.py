@@ -1,9 +1,17 @@
 import rom
+import patch
 from rom import readword, readtablebyte, readtableword, readbyte
 from sprites import SPRITE_NAMES
 import copy
 import traceback
 import hashlib
+import json
+import bisect
+import heapq
+import time
+import os
+import shutil
+import concurrent.futures
 
 VERSION_INT=2025021616
 VERSION_NAME="v1.4"
@@ -485,14 +493,58 @@ def loadSublevelScreenTable(j, level, sublevel):
             if jsl.layout[x][y] & 0xF >= len(jsl.screens):
                 jsl.layout[x][y] = 0
                 
-def getLevelChunksAndGlitchChunks(j, level):
+# read-only sequence over a level's chunks followed by the chunks of the levels after it
+# (which screens can reach as glitch chunks), without copying any of them.
+class ChunkChain:
+    def __init__(self, segments):
+        self.segments = segments
+        self.lengths = [len(segment) for segment in segments]
+        self.starts = [sum(self.lengths[:i]) for i in range(len(segments))]
+        self.length = sum(self.lengths)
+    
+    # true if this view still describes the given chunk lists
+    def matches(self, segments):
+        return len(segments) == len(self.segments) and all(
+            a is b and len(a) == length for a, b, length in zip(segments, self.segments, self.lengths)
+        )
+    
+    def __len__(self):
+        return self.length
+    
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError("chunk index out of range")
+        i = bisect.bisect_right(self.starts, index) - 1
+        return self.segments[i][index - self.starts[i]]
+    
+    def __iter__(self):
+        for segment in self.segments:
+            yield from segment
+
+# returns the list of chunk lists visible from the given level, in order
+def getLevelChunkSegments(j, level):
     if j.levels[level].get("chunks", None) is not None:
         chunks = j.levels[level].chunks
         if len(chunks) < 0x100 and rom.LEVELS[level+1] != "Drac3":
-            return chunks + getLevelChunksAndGlitchChunks(j, level+1)
-        return chunks + []
+            return [chunks] + getLevelChunkSegments(j, level+1)
+        return [chunks]
     else:
-        return getLevelChunksAndGlitchChunks(j, j.levels[level].chunklink)
+        return getLevelChunkSegments(j, j.levels[level].chunklink)
+
+# maps level -> ChunkChain
+chunkChainCache = dict()
+
+# returns a read-only sequence of this level's chunks, followed by the chunks which
+# can be reached past the end of them.
+def getLevelChunksAndGlitchChunks(j, level):
+    segments = getLevelChunkSegments(j, level)
+    chain = chunkChainCache.get(level, None)
+    if chain is None or not chain.matches(segments):
+        chain = ChunkChain(segments)
+        chunkChainCache[level] = chain
+    return chain
             
 def getLevelChunks(j, level):
     if j.levels[level].get("chunks", None) is not None:
@@ -616,9 +668,14 @@ def screenUsed(j, level, sublevel, screen):
     return False
     
 # is there a way to enter this screen through a portal or door?
-def getScreenEnterable(j, level, sublevel, x, y):
-    jl = j.levels[level]
-    jsl = jl.sublevels[sublevel]
+# (pass the sublevel's graph if the caller already has it, to skip checking that it's up to date)
+def getScreenEnterable(j, level, sublevel, x, y, graph=None):
+    graph = graph or getSublevelGraph(j, level, sublevel)
+    return graph.enterable[x][y]
+
+# as above, but computed from scratch.
+# portals: screen -> result of getScreenPortals
+def computeScreenEnterable(jsl, x, y, portals):
     if (x, y) == (jsl.startx, jsl.starty):
         return True
     if jsl.layout[x][y] == 0:
@@ -647,12 +704,53 @@ def getScreenEnterable(j, level, sublevel, x, y):
                 if jsl.vertical == 0 and xoff < 0 and t in [0x8, 0xA]:
                     continue
                 
-                if (-xoff, -yoff) in getScreenPortals(j, level, sublevel, neighbour & 0x0F):
+                if (-xoff, -yoff) in portals[neighbour & 0x0F]:
                     return True
     return False
 
-def getEnterabilityLayout(j, level, sublevel):
-    return [[getScreenEnterable(j, level, sublevel, x, y) for y in range(16)] for x in range(16)]
+def getEnterabilityLayout(j, level, sublevel, graph=None):
+    # (shared with the cached graph -- don't modify the result.)
+    graph = graph or getSublevelGraph(j, level, sublevel)
+    return graph.enterable
+
+# how a sublevel's screens connect to each other:
+# - doors: screen -> subset of {-1, 1} (see getScreenExitDoor)
+# - portals: screen -> ropes leaving the screen (see getScreenPortals)
+# - enterable: 16x16 array, whether each cell can be entered other than by scrolling
+class SublevelGraph:
+    def __init__(self, j, level, sublevel):
+        jsl = j.levels[level].sublevels[sublevel]
+        self.doors = [getScreenExitDoor(j, level, sublevel, screen) for screen in range(len(jsl.screens))]
+        self.portals = [getScreenPortals(j, level, sublevel, screen) for screen in range(len(jsl.screens))]
+        self.enterable = [[computeScreenEnterable(jsl, x, y, self.portals) for y in range(16)] for x in range(16)]
+
+# the graph only depends on the sublevel's layout, its screens, and the chunks those screens use.
+def getSublevelGraphSignature(j, level, sublevel):
+    jsl = j.levels[level].sublevels[sublevel]
+    chunks = getLevelChunksAndGlitchChunks(j, level)
+    screens = tuple(tuple(tuple(row) for row in js.data) for js in jsl.screens)
+    chidxs = sorted(set(chidx for screen in screens for row in screen for chidx in row))
+    usedChunks = tuple(tuple(chunks[chidx]) if chidx < len(chunks) else None for chidx in chidxs)
+    return (
+        tuple(tuple(col) for col in jsl.layout),
+        jsl.startx, jsl.starty, jsl.vertical,
+        screens, tuple(chidxs), usedChunks
+    )
+
+# maps (level, sublevel) -> (signature, SublevelGraph)
+sublevelGraphCache = dict()
+
+# returns the SublevelGraph for this sublevel, recomputing it only if the sublevel
+# (or the chunks it uses) changed since it was last requested.
+# checking that takes a pass over the sublevel, so callers making many lookups should hold on to the graph.
+def getSublevelGraph(j, level, sublevel):
+    signature = getSublevelGraphSignature(j, level, sublevel)
+    cached = sublevelGraphCache.get((level, sublevel), None)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    graph = SublevelGraph(j, level, sublevel)
+    sublevelGraphCache[(level, sublevel)] = (signature, graph)
+    return graph
 
 def loadSublevelTimer(j, level, sublevel):
     jl = j.levels[level]
@@ -663,12 +761,46 @@ def loadSublevelTimer(j, level, sublevel):
 
 # ------------------------------------------------------
 
+# a compileCache kept across compiles (see SaveContext) is dropped and rebuilt past this many entries
+COMPILE_CACHE_MAX = 0x4000
+
+def trimCompileCache(cache):
+    if len(cache) > COMPILE_CACHE_MAX:
+        cache.clear()
+
 class SaveContext:
     def __init__(self, gb, j, **kwargs):
         self.gb = list(copy.copy(gb))
         self.j = j
         self.playtestStart = kwargs.get("playtestStart", None)
+        # seconds to spend searching for an optimal layout cover on small sublevels (None: greedy only)
+        self.exactCoverBudget = kwargs.get("exactCoverBudget", None)
+        # seconds to spend overlapping ScreenTiles and entity hunks with each other (None: lay them out end to end)
+        self.packBudget = kwargs.get("packBudget", None)
+        # merge duplicate chunks and drop unused ones, renumbering the screens which use them (see compactChunks)
+        self.compactChunks = kwargs.get("compactChunks", False)
+        # number of worker processes to compile independent regions with (see writeRegionsParallel);
+        # True for one per cpu. An existing concurrent.futures executor can be passed as "executor" instead.
+        self.parallel = kwargs.get("parallel", None)
+        self.executor = kwargs.get("executor", None)
+        self.options = kwargs
+        # suppresses progress output (e.g. when validating from the editor on every edit)
+        self.quiet = kwargs.get("quiet", False)
+        # if the caller passes a Profile, timings and counters are recorded in it (see saveRom)
+        self.profile = kwargs.get("profile", None)
+        if self.profile is not None:
+            # (timed from the start of the compile, not from when the caller made it)
+            self.profile.start = time.monotonic()
+        # if set, debug artifacts are collected in memory during the compile and written here at the end
+        self.debugDir = kwargs.get("debugDir", None)
+        self.debugArtifacts = None if self.debugDir is None else dict() # filename -> bytes
+        # per-sublevel results keyed by their inputs, kept by the caller across compiles (see produceScreenLayoutPackets)
+        self.compileCache = kwargs.get("compileCache", None)
+        # if the caller passes a ProvenanceIndex, what produced each written range is recorded in it
+        self.provenance = kwargs.get("provenance", None)
         self.errors = []
+        # errors which can be traced to a place in the hack (see addProblem)
+        self.problems = []
         self.regions = JSONDict({
             "ScreenTilesTable": {
                 "shortname": "ST",
@@ -777,6 +909,26 @@ class SaveContext:
             self.regions[key].used = 0
             self.regions[key].subranges = JSONDict()
         
+        # space that patches and overflowing tables can be placed in (see allocate).
+        # freeRanges: list of (bank, start, end) known to be unused by the game, in addition to what's left over in the regions.
+        self.freeSpace = FreeSpace()
+        # (those which passed the checks below; see writeRegionsParallel)
+        self.acceptedFreeRanges = []
+        for bank, start, end in kwargs.get("freeRanges", None) or []:
+            overlaps = [
+                key for key, region in self.regions.items()
+                if region.bank == bank and start < region.addr + region.max and region.addr < end
+            ]
+            if len(overlaps) > 0:
+                self.errors.append(f"Free range {bank:X}:{start:04X}-{end:04X} overlaps region \"{overlaps[0]}\"; ignoring it.")
+                continue
+            try:
+                self.freeSpace.add(bank, start, end)
+            except Exception as e:
+                self.errors.append(f"{e}; ignoring it.")
+                continue
+            self.acceptedFreeRanges.append((bank, start, end))
+        
         # maps (level, sublevel) -> list[(x, y, l)]
         self.uniqueScreens = dict()
         
@@ -790,6 +942,78 @@ class SaveContext:
         self.enterableScreenData = dict()
         
         self.sublevelInitSubroutines = dict()
+        
+        # maps (level, sublevel, preview) -> layout (see constructRemappedLayout)
+        self.remappedLayouts = dict()
+        
+        # maps (level, sublevel) -> SublevelGraph; j doesn't change during a compile, so these needn't be rechecked.
+        self.sublevelGraphs = dict()
+        
+        # contiguous runs of bytes written, in order: list of [romaddr, bytearray]
+        self.writeLog = []
+        
+        # maps 20 bytes of screen tiles -> lowest address in ScreenTiles holding them (see indexScreenTiles)
+        self.screenTilesIndex = dict()
+        self.screenTilesIndexed = 0 # number of bytes at the start of ScreenTiles covered by the index
+        
+        # maps (level, sublevel, cat) -> list[[start, end, source]] for each entity packet,
+        # held back until the hunk's final address is known (see writeEntityCategory)
+        self.entityPacketSources = dict()
+    
+    # runs f(*args, **kwargs), timing it as the given phase if profiling
+    def phase(self, name, f, *args, **kwargs):
+        if self.profile is None:
+            return f(*args, **kwargs)
+        return self.profile.phase(name, f, *args, **kwargs)
+    
+    # records a debug artifact (bytes, or something json-friendly), if collecting them
+    def addDebugArtifact(self, name, data):
+        if self.debugArtifacts is not None:
+            if type(data) not in [bytes, bytearray]:
+                data = json.dumps(data, indent=4).encode("utf-8")
+            self.debugArtifacts[name] = bytes(data)
+    
+    # records an error, along with where it is in the hack (so the editor can point it out).
+    # x and y are layout coordinates.
+    def addProblem(self, message, level=None, sublevel=None, x=None, y=None):
+        self.errors.append(message)
+        self.problems.append(JSONDict(message=message, level=level, sublevel=sublevel, x=x, y=y))
+    
+    # finds size bytes of free space (see FreeSpace.allocate) and marks them used.
+    # space taken from the end of a region counts towards that region.
+    # returns (bank, addr), or None if there is no room.
+    def allocate(self, size, bank=None, align=1, label=None):
+        found = self.freeSpace.allocate(size, bank, align)
+        if found is None:
+            return None
+        bank, addr, key = found
+        label = label or f"Alloc{addr:04X}"
+        if key is not None:
+            region = self.regions[key]
+            region.used = addr + size - region.addr
+            while label in region.subranges:
+                label += "*"
+            region.subranges[label] = JSONDict(start=addr, end=addr + size)
+        self.freeSpace.allocations.append(JSONDict(label=label, bank=bank, start=addr, end=addr + size, region=key))
+        self.addProvenance(bank, addr, addr + size, label)
+        self.count("bytesAllocated", size)
+        return bank, addr
+    
+    # records that the bytes [start, end) in the bank were produced from the given source (see ProvenanceIndex)
+    def addProvenance(self, bank, start, end, label, **source):
+        if self.provenance is not None and end > start:
+            self.provenance.add(self.romaddr(bank, start), JSONDict(label=label, bank=bank, start=start, end=end, **source))
+    
+    # adds to a profiling counter
+    def count(self, name, n=1):
+        if self.profile is not None:
+            self.profile.count(name, n)
+    
+    def getSublevelGraph(self, level, sublevel):
+        key = (level, sublevel)
+        if key not in self.sublevelGraphs:
+            self.sublevelGraphs[key] = getSublevelGraph(self.j, level, sublevel)
+        return self.sublevelGraphs[key]
     
     # returns screen, js
     def getUniqueScreenOriginalScreen(self, level, sublevel, uscreen):
@@ -811,7 +1035,21 @@ class SaveContext:
     def writeByte(self, bank, addr, v):
         if type(v) != int or v < 0 or v >= 0x100:
             raise Exception(f"Error with value {v}")
-        self.gb[self.romaddr(bank, addr)] = v
+        romaddr = self.romaddr(bank, addr)
+        self.gb[romaddr] = v
+        if len(self.writeLog) > 0 and self.writeLog[-1][0] + len(self.writeLog[-1][1]) == romaddr:
+            self.writeLog[-1][1].append(v)
+        else:
+            self.writeLog.append([romaddr, bytearray([v])])
+    
+    # replays a write log from another context
+    def applyWriteLog(self, log):
+        for romaddr, data in log:
+            self.gb[romaddr:romaddr + len(data)] = data
+            if len(self.writeLog) > 0 and self.writeLog[-1][0] + len(self.writeLog[-1][1]) == romaddr:
+                self.writeLog[-1][1].extend(data)
+            else:
+                self.writeLog.append([romaddr, bytearray(data)])
     
     def writeWord(self, bank, addr, v, littleEndian=True):
         if littleEndian:
@@ -830,25 +1068,280 @@ class SaveContext:
         else:
             return self.readByte(bank, addr+1) | (self.readByte(bank, addr) << 8)
         
+# wall time and call count per compile phase, plus counts of inner operations
+class Profile:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.phases = dict() # name -> [seconds, calls]
+        self.counters = dict() # name -> int
+        # the report (see Profile.report), once the compile has finished
+        self.result = None
+    
+    def phase(self, name, f, *args, **kwargs):
+        t = time.monotonic()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            self.addPhase(name, time.monotonic() - t)
+    
+    def addPhase(self, name, seconds, calls=1):
+        if name not in self.phases:
+            self.phases[name] = [0, 0]
+        self.phases[name][0] += seconds
+        self.phases[name][1] += calls
+    
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+    
+    # adds in the phases and counters of another profile (e.g. from a worker process)
+    def merge(self, other):
+        for name, (seconds, calls) in other.phases.items():
+            self.addPhase(name, seconds, calls)
+        for name, n in other.counters.items():
+            self.count(name, n)
+    
+    # a json-friendly report
+    def report(self, ctx):
+        regions = JSONDict()
+        for key, region in ctx.regions.items():
+            start = ctx.romaddr(region.bank, region.addr)
+            end = start + region.max
+            written = 0
+            for romaddr, data in ctx.writeLog:
+                written += max(0, min(end, romaddr + len(data)) - max(start, romaddr))
+            regions[key] = JSONDict(used=region.used, max=region.max, written=written)
+        return JSONDict(
+            total=time.monotonic() - self.start,
+            phases=[JSONDict(name=name, time=seconds, calls=calls) for name, (seconds, calls) in self.phases.items()],
+            regions=regions,
+            counters=JSONDict(self.counters, bytesWritten=sum(len(data) for romaddr, data in ctx.writeLog)),
+        )
+
+# index of the free space in each bank: what's left at the end of each region once it has been
+# written (see indexFreeSpace), plus any ranges known to be free (the freeRanges option).
+class FreeSpace:
+    def __init__(self):
+        # bank -> sorted list of [start, end, region key or None]
+        self.banks = dict()
+        # JSONDicts of label, bank, start, end, region (see SaveContext.allocate)
+        self.allocations = []
+    
+    def add(self, bank, start, end, key=None):
+        if end <= start:
+            return
+        ranges = self.banks.setdefault(bank, [])
+        i = bisect.bisect_left(ranges, [start])
+        for other in ranges[max(i - 1, 0):i + 1]:
+            if other[0] < end and start < other[1]:
+                raise Exception(f"Free range {bank:X}:{start:04X}-{end:04X} overlaps {bank:X}:{other[0]:04X}-{other[1]:04X}")
+        ranges.insert(i, [start, end, key])
+    
+    # adds the unused end of a region, which must not be written to any further except through allocate.
+    def addRegion(self, region):
+        if region.used is not None and region.used < region.max:
+            self.add(region.bank, region.addr + region.used, region.addr + region.max, region.key)
+    
+    # bank: a bank number, a list of them, or None for any bank.
+    # takes the first fit from the lowest bank and address, so space at the end of each region is handed out in order.
+    # returns (bank, addr, region key or None), or None if there is no room.
+    def allocate(self, size, bank=None, align=1):
+        if bank is None:
+            banks = sorted(self.banks.keys())
+        elif type(bank) == int:
+            banks = [bank]
+        else:
+            banks = sorted(bank)
+        for bank in banks:
+            ranges = self.banks.get(bank, [])
+            for i, (start, end, key) in enumerate(ranges):
+                addr = start + (-start % align)
+                if addr + size > end:
+                    continue
+                # (a region's range stays contiguous with what it has used; alignment padding is lost to it.)
+                rest = [[addr + size, end, key]] if addr + size < end else []
+                if key is None and addr > start:
+                    rest = [[start, addr, None]] + rest
+                ranges[i:i + 1] = rest
+                return bank, addr, key
+        return None
+    
+    # number of free bytes in the bank (or in all banks)
+    def total(self, bank=None):
+        banks = self.banks.keys() if bank is None else [bank]
+        return sum(end - start for bank in banks for start, end, key in self.banks.get(bank, []))
+    
+    # a json-friendly summary
+    def report(self):
+        return JSONDict(
+            free=[JSONDict(bank=bank, start=start, end=end, region=key) for bank in sorted(self.banks.keys()) for start, end, key in self.banks[bank]],
+            allocations=self.allocations,
+        )
+
+# maps written rom ranges back to whatever in the hack produced them, for the editor to show and navigate to.
+# sources are JSONDicts of label, bank, start, end (bank addresses), and whichever of
+# level, sublevel, screen (as in the hack, not remapped), cat, x, y (layout coordinates) and chunk apply.
+# ranges may overlap (e.g. an entity packet inside its sublevel's hunk, or hunks shared between sublevels).
+class ProvenanceIndex:
+    def __init__(self):
+        self.entries = [] # (romaddr, source)
+        # disjoint segments covering the entries, built on demand (see build):
+        self.starts = [] # sorted romaddrs
+        self.segments = [] # (end romaddr, sources covering the segment, smallest first)
+        self.built = True
+    
+    def add(self, romaddr, source):
+        self.entries.append((romaddr, source))
+        self.built = False
+    
+    # cuts the entries into disjoint segments, so that lookups are a binary search.
+    def build(self):
+        if self.built:
+            return
+        events = dict() # romaddr -> [starting, ending]
+        for romaddr, source in self.entries:
+            events.setdefault(romaddr, [[], []])[0].append(source)
+            events.setdefault(romaddr + source.end - source.start, [[], []])[1].append(source)
+        self.starts = []
+        self.segments = []
+        active = []
+        points = sorted(events.keys())
+        for i, point in enumerate(points):
+            starting, ending = events[point]
+            ended = set(id(source) for source in ending)
+            active = [source for source in active if id(source) not in ended] + starting
+            if len(active) > 0 and i + 1 < len(points):
+                self.starts.append(point)
+                self.segments.append((points[i + 1], sorted(active, key=lambda source: source.end - source.start)))
+        self.built = True
+    
+    # the sources of the byte at the given address, most specific (smallest) first
+    def lookup(self, bank, addr):
+        self.build()
+        romaddr = bank * 0x4000 + addr % 0x4000
+        i = bisect.bisect_right(self.starts, romaddr) - 1
+        if i < 0 or romaddr >= self.segments[i][0]:
+            return []
+        return self.segments[i][1]
+
+# the rom ranges written during the compile, sorted and merged: list of (start, end)
+def getWrittenRanges(ctx: SaveContext):
+    ranges = []
+    for start, end in sorted((romaddr, romaddr + len(data)) for romaddr, data in ctx.writeLog):
+        if len(ranges) > 0 and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(end, ranges[-1][1]))
+        else:
+            ranges.append((start, end))
+    return ranges
+
 # returns:
 #  - a list of (regionname, size, maxsize)
 #  - a list of errors, or empty if successful
+# if a Profile is passed as the profile option, its report is left in profile.result.
+# options ipsPath and bpsPath write an IPS/BPS patch from the base rom alongside (or instead of) the rom.
 def saveRom(gb, j, path=None, **kwargs):
     assert(len(gb) > 0 and len(gb) % 0x4000 == 0)
     ctx = SaveContext(gb, j, **kwargs)
     
     _saveRom(ctx)
-    regions, errors, gb = ctx.result
-    if path is not None and gb is not None:
+    regions, errors, outgb = ctx.result
+    if ctx.debugArtifacts is not None:
+        if outgb is not None:
+            addCompileDebugArtifacts(ctx)
+        errors += writeDebugArtifacts(ctx)
+    def writeOutput(path, getData):
         try:
-            with open(path, "wb") as f:
-                f.write(gb)
+            if not writeFileIfChanged(path, getData()):
+                ctx.count("outputsUnchanged")
         except IOError as e:
-            errors += [f"I/O Error writing to file {path}: {e}"]
+            errors.append(f"I/O Error writing to file {path}: {e}")
         except OSError as e:
-            errors += [f"OS Error writing to file {path}: {e}"]
+            errors.append(f"OS Error writing to file {path}: {e}")
+        except Exception as e:
+            errors.append(f"Error producing {path}: {e}")
+    if outgb is not None:
+        if path is not None:
+            writeOutput(path, lambda: outgb)
+        # patches only compare the ranges written during the compile
+        if kwargs.get("ipsPath", None) is not None:
+            writeOutput(kwargs["ipsPath"], lambda: patch.makeIPS(bytes(gb), outgb, getWrittenRanges(ctx)))
+        if kwargs.get("bpsPath", None) is not None:
+            writeOutput(kwargs["bpsPath"], lambda: patch.makeBPS(bytes(gb), outgb, getWrittenRanges(ctx)))
+    if ctx.profile is not None:
+        ctx.profile.result = ctx.profile.report(ctx)
     return regions, errors
     
+# region contents, subrange maps and screen remapping tables
+def addCompileDebugArtifacts(ctx: SaveContext):
+    subranges = JSONDict()
+    for key, region in ctx.regions.items():
+        start = ctx.romaddr(region.bank, region.addr)
+        ctx.addDebugArtifact(f"regions/{key}.bin", bytes(ctx.gb[start:start + region.used]))
+        subranges[key] = JSONDict(bank=region.bank, addr=region.addr, used=region.used, max=region.max, subranges=region.subranges)
+    ctx.addDebugArtifact("subranges.json", subranges)
+    
+    remap = []
+    for (level, sublevel), uscreens in ctx.uniqueScreens.items():
+        remap.append(JSONDict(
+            level=level,
+            sublevel=sublevel,
+            name=f"{ctx.j.levels[level].name}-{sublevel+1}",
+            uniqueScreens=[list(uscreen) for uscreen in uscreens],
+            priorityUniqueScreens=ctx.numPriorityUniqueScreens.get((level, sublevel), None),
+            screenRemap=[
+                JSONDict(x=x, y=y, uscreen=uscreen)
+                for (_level, _sublevel, x, y), uscreen in ctx.screenRemap.items()
+                if (_level, _sublevel) == (level, sublevel)
+            ],
+        ))
+    ctx.addDebugArtifact("remap.json", remap)
+    ctx.addDebugArtifact("freespace.json", ctx.freeSpace.report())
+    if ctx.provenance is not None:
+        ctx.addDebugArtifact("provenance.json", [source for romaddr, source in sorted(ctx.provenance.entries, key=lambda entry: entry[0])])
+
+# writes out the collected debug artifacts; returns a list of errors
+def writeDebugArtifacts(ctx: SaveContext):
+    try:
+        for name, data in ctx.debugArtifacts.items():
+            path = os.path.join(ctx.debugDir, *name.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            writeFileIfChanged(path, data)
+    except OSError as e:
+        return [f"Error writing debug artifacts to {ctx.debugDir}: {e}"]
+    return []
+
+def getFileDigest(path, blocksize=0x10000):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(blocksize)
+            if len(block) == 0:
+                return h.digest()
+            h.update(block)
+
+# writes data to path, unless the file there already has exactly these contents
+# (so that e.g. an emulator watching the file only reloads on real changes).
+# the data goes to a temporary file beside path which is then renamed over it, so readers never see a partial file.
+# returns False if the write was skipped.
+def writeFileIfChanged(path, data):
+    try:
+        if os.path.getsize(path) == len(data) and getFileDigest(path) == hashlib.sha1(data).digest():
+            return False
+    except OSError:
+        # doesn't exist yet (or can't be read; just try writing it)
+        pass
+    tmppath = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmppath, "wb") as f:
+            f.write(data)
+        if os.path.exists(path):
+            shutil.copymode(path, tmppath)
+        os.replace(tmppath, path)
+    except Exception:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+    return True
+
 def _saveRom(ctx: SaveContext):
     try:
         writeRom(ctx)
@@ -870,28 +1363,45 @@ def _saveRom(ctx: SaveContext):
 def writeRom(ctx: SaveContext):
     # TODO: tileset_common (* no gui support)
     # TODO: level.tileset  (* no gui support)
-    constructScreenRemapping(ctx)
-    writeScreenTiles(ctx)
-    writeScreenLayout(ctx)
-    writeSublevelTimer(ctx)
-    writeSublevelVertical(ctx)
-    writeEntities(ctx)
-    writeChunks(ctx)
+    if ctx.compactChunks:
+        ctx.phase("compactChunks", compactChunks, ctx)
+    ctx.phase("constructScreenRemapping", constructScreenRemapping, ctx)
+    if ctx.parallel or ctx.executor is not None:
+        ctx.phase("writeRegionsParallel", writeRegionsParallel, ctx)
+    else:
+        ctx.phase("writeScreenTiles", writeScreenTiles, ctx)
+        ctx.phase("writeScreenLayout", writeScreenLayout, ctx)
+        ctx.phase("writeSublevelTimer", writeSublevelTimer, ctx)
+        ctx.phase("writeSublevelVertical", writeSublevelVertical, ctx)
+        writeEntities(ctx)
+        ctx.phase("writeChunks", writeChunks, ctx)
+    
+    # what's left of the regions written so far can be allocated from now on.
+    # (ScreenTiles still grows as the routines below add screens to it.)
+    indexFreeSpace(ctx, [key for key in ctx.regions.keys() if key not in LATE_REGIONS])
     
     if ctx.playtestStart is not None:
-        writePlaytestStart(ctx, *ctx.playtestStart)
+        ctx.phase("writePlaytestStart", writePlaytestStart, ctx, *ctx.playtestStart)
     
     # this one reads some of the screenTiles from before
-    writeSublevelInitRoutines(ctx)
+    ctx.phase("writeSublevelInitRoutines", writeSublevelInitRoutines, ctx)
     
-    writeEntLoadRoutine(ctx, ctx.regions.EntC4Routine, ctx.j.entC4Routine, label="EntC4")
-    writeEntLoadRoutine(ctx, ctx.regions.Ent78Routine, ctx.j.ent78Routine, False, label="Ent78")
-    writeEntLoadRoutine(ctx, ctx.regions.CrusherRoutine, ctx.j.crusherRoutine, False, label="Crusher")
+    ctx.phase("writeEntLoadRoutine.EntC4", writeEntLoadRoutine, ctx, ctx.regions.EntC4Routine, ctx.j.entC4Routine, label="EntC4")
+    ctx.phase("writeEntLoadRoutine.Ent78", writeEntLoadRoutine, ctx, ctx.regions.Ent78Routine, ctx.j.ent78Routine, False, label="Ent78")
+    ctx.phase("writeEntLoadRoutine.Crusher", writeEntLoadRoutine, ctx, ctx.regions.CrusherRoutine, ctx.j.crusherRoutine, False, label="Crusher")
+    indexFreeSpace(ctx, LATE_REGIONS)
     
     # do this one last, it's an opportunist
-    writeLoadEnclosedScreenEntityBugfixPatch(ctx)
+    ctx.phase("writeLoadEnclosedScreenEntityBugfixPatch", writeLoadEnclosedScreenEntityBugfixPatch, ctx)
     
-    writeLoadLayoutPatch(ctx)
+    ctx.phase("writeLoadLayoutPatch", writeLoadLayoutPatch, ctx)
+
+# regions which are written after the others (or added to, in the case of ScreenTiles)
+LATE_REGIONS = ["ScreenTiles", "SublevelInitRoutines", "EntC4Routine", "Ent78Routine", "CrusherRoutine"]
+
+def indexFreeSpace(ctx: SaveContext, keys):
+    for key in keys:
+        ctx.freeSpace.addRegion(ctx.regions[key])
 
 # basically just for cloud castle flicker preview at door to final sublevel
 def requiresVerticalPreview(jsl):
@@ -909,7 +1419,7 @@ def constructScreenRemapping(ctx: SaveContext):
 def constructScreenRemappingForSublevel(ctx: SaveContext, level: int, sublevel: int):
     jl = ctx.j.levels[level]
     jsl = jl.sublevels[sublevel]
-    enterable = getEnterabilityLayout(ctx.j, level, sublevel)
+    enterable = ctx.getSublevelGraph(level, sublevel).enterable
     
     # screenMap: coords -> out index
     # - skip unused screens
@@ -928,30 +1438,23 @@ def constructScreenRemappingForSublevel(ctx: SaveContext, level: int, sublevel:
     # - both are enterable, but both also appear in identical continuous rooms at the same x value (y if vertical)
     # - the last condition is a lot of work to check, so instead we simplify it to
     #   "both are enclosed (0xB*)"
-    
-    def combinable(x1, y1, x2, y2):
-        l1 = jsl.layout[x1][y1]
-        l2 = jsl.layout[x2][y2]
-        e1 = enterable[x1][y1]
-        e2 = enterable[x2][y2]
-        t1 = l1 >> 4
-        t2 = l2 >> 4
-        s1 = l1 & 0x0F
-        s2 = l2 & 0x0F
-        js1 = jsl.screens[s1]
-        js2 = jsl.screens[s2]
-        
-        if js1.data == js2.data: # tiles the same
-            if not e1 or not e2:
-                return True
-            else:
-                assert e1 and e2
-                return t1 == 0xB and t2 == 0xB
-                
-        return False
+    #
+    # so we bucket cells by their tiles, and for each bucket remember the first cell
+    # of each enterability class. A new cell then combines with the earliest cell
+    # in its bucket that it is compatible with:
+    # - not enterable: any cell
+    # - enterable, enclosed: a non-enterable cell or an enterable enclosed cell
+    # - enterable, otherwise: a non-enterable cell
+    ANY = 0
+    NONENTERABLE = 1
+    NONENTERABLE_OR_ENCLOSED = 2
+    
+    def getScreenKey(l):
+        return tuple(tuple(row) for row in jsl.screens[l & 0x0F].data)
     
     uniqueScreens = []
     uniqueScreensPriority = []
+    buckets = dict() # screen tiles -> [uscreen | None for each class]
     
     def getPriority(x, y):
         priority = 0 if enterable[x][y] else 2
@@ -966,21 +1469,33 @@ def constructScreenRemappingForSublevel(ctx: SaveContext, level: int, sublevel:
                 priority -= 1
         return priority
     
-    for i, (x, y) in enumerate(screenCoords):
+    for x, y in screenCoords:
         l = jsl.layout[x][y]
-        if not screenUsed(ctx.j, level ,sublevel, l & 0x0F):
-            continue
+        e = enterable[x][y]
+        enclosed = l >> 4 == 0xB
+        bucket = buckets.setdefault(getScreenKey(l), [None, None, None])
+        if not e:
+            uscreen = bucket[ANY]
+        elif enclosed:
+            uscreen = bucket[NONENTERABLE_OR_ENCLOSED]
         else:
-            for j, (x2, y2) in enumerate(screenCoords[:i]):
-                if combinable(x, y, x2, y2):
-                    uscreen = ctx.screenRemap[(level, sublevel, x2, y2)]
-                    ctx.screenRemap[(level, sublevel, x, y)] = uscreen
-                    uniqueScreensPriority[uscreen] = min(getPriority(x, y), uniqueScreensPriority[uscreen])
-                    break
-            else:
-                ctx.screenRemap[(level, sublevel, x, y)] = len(uniqueScreens)
-                uniqueScreensPriority.append(getPriority(x, y))
-                uniqueScreens.append((x, y, l))
+            uscreen = bucket[NONENTERABLE]
+        
+        if uscreen is not None:
+            uniqueScreensPriority[uscreen] = min(getPriority(x, y), uniqueScreensPriority[uscreen])
+        else:
+            uscreen = len(uniqueScreens)
+            uniqueScreensPriority.append(getPriority(x, y))
+            uniqueScreens.append((x, y, l))
+        ctx.screenRemap[(level, sublevel, x, y)] = uscreen
+        
+        # record this cell as the earliest of its class(es), if it's the first such.
+        if bucket[ANY] is None:
+            bucket[ANY] = uscreen
+        if not e and bucket[NONENTERABLE] is None:
+            bucket[NONENTERABLE] = uscreen
+        if (not e or enclosed) and bucket[NONENTERABLE_OR_ENCLOSED] is None:
+            bucket[NONENTERABLE_OR_ENCLOSED] = uscreen
     
     if len(uniqueScreens) >= 0x10:
         levelname = rom.LEVELS[level]
@@ -993,16 +1508,20 @@ def constructScreenRemappingForSublevel(ctx: SaveContext, level: int, sublevel:
         if len(jl.sublevels[sublevel-1]) + numPrioritizedScreens + numNonPrioritizedPreviewScreens > 0x10:
             # move preview screens so that they are at the start
             # unusual behaviour, so let's print it out in case it causes problems.
-            print(f"{rom.LEVELS[level]}-{sublevel+1} - Remapping some screen IDs to allow previous sublevel access to the start-adjacent room(s)...")
-            print("<- ", level, sublevel+1, uniqueScreensPriority)
+            if not ctx.quiet:
+                print(f"{rom.LEVELS[level]}-{sublevel+1} - Remapping some screen IDs to allow previous sublevel access to the start-adjacent room(s)...")
+                print("<- ", level, sublevel+1, uniqueScreensPriority)
             uniqueScreensPriority = [(u if u != 1 else -1) for u in uniqueScreensPriority]
-            print(" -> ", level, sublevel+1, uniqueScreensPriority)
+            if not ctx.quiet:
+                print(" -> ", level, sublevel+1, uniqueScreensPriority)
     
     ctx.numPriorityUniqueScreens[(level, sublevel)] = sum([p <= 0 for p in uniqueScreensPriority])
     
     # remap unique screens to ensure the enterable ones come first, and starting room is the very first.
     remapEnterable = sorted(list(range(len(uniqueScreens))), key=lambda i: uniqueScreensPriority[i])
-    remapEnterableIndices = [remapEnterable.index(i) for i in range(len(uniqueScreens))]
+    remapEnterableIndices = [None] * len(uniqueScreens)
+    for i, u in enumerate(remapEnterable):
+        remapEnterableIndices[u] = i
     #if level == 4 and sublevel == 1:
     #    print(uniqueScreens, "|", remapEnterable)
     #    for (_level, _sublevel, x, y), v in ctx.screenRemap.items():
@@ -1014,6 +1533,7 @@ def constructScreenRemappingForSublevel(ctx: SaveContext, level: int, sublevel:
         ctx.screenRemap[(level, sublevel, x, y)] = remapEnterableIndices[ctx.screenRemap[(level, sublevel, x, y)]]
     
     ctx.uniqueScreens[(level, sublevel)] = [uniqueScreens[remapEnterable[i]] for i in range(len(uniqueScreens))]
+    ctx.count("uniqueScreens", len(uniqueScreens))
     
     #if level == 7:
     #    printRemappedScreenLayout(ctx, level, sublevel)
@@ -1043,6 +1563,39 @@ def writeScreenTiles(ctx: SaveContext):
     addr = ctx.regions.ScreenTiles.addr
     subranges = ctx.regions.ScreenTiles.subranges
     
+    # each level's screens, sublevel by sublevel.
+    # (a sublevel's preview screens are read from the start of the next sublevel's screens,
+    # so a level's sublevels must stay adjacent and in order.)
+    levelData = dict()
+    sublevelOffsets = dict()
+    for level, jl in enumerate(ctx.j.levels):
+        if level != 0:
+            levelData[level] = []
+            for sublevel, jsl in enumerate(jl.sublevels):
+                sublevelOffsets[(level, sublevel)] = len(levelData[level])
+                for uscreen, uscm in enumerate(ctx.uniqueScreens[(level, sublevel)]):
+                    oscreen, js = ctx.getUniqueScreenOriginalScreen(level, sublevel, uscreen)
+                    for y in range(4):
+                        for x in range(5):
+                            # TODO: remap chunks also :)
+                            levelData[level].append(js.data[y][x])
+    
+    # place levels end to end, or overlapped if packing
+    levels = list(levelData.keys())
+    packed = None
+    if ctx.packBudget is not None:
+        packed = packShortestSuperstring([levelData[level] for level in levels], ctx.packBudget)
+    if packed is None:
+        data = flatten(levelData[level] for level in levels)
+        levelAddrs = dict()
+        for level in levels:
+            levelAddrs[level] = addr
+            addr += len(levelData[level])
+    else:
+        data, offsets = packed
+        levelAddrs = {level: addr + offset for level, offset in zip(levels, offsets)}
+    ctx.writeBytes(bank, ctx.regions.ScreenTiles.addr, data)
+    
     tsaddr = taddr + len(ctx.j.levels)*2
     for level, jl in enumerate(ctx.j.levels):
         if level == 0:
@@ -1052,19 +1605,17 @@ def writeScreenTiles(ctx: SaveContext):
             taddr += 2
             for sublevel, jsl in enumerate(jl.sublevels):
                 subrangekey = f"{jl.name}-{sublevel+1}"
-                subranges[subrangekey] = JSONDict(start=addr)
-                ctx.writeWord(tbank, tsaddr, addr)
+                start = levelAddrs[level] + sublevelOffsets[(level, sublevel)]
+                subranges[subrangekey] = JSONDict(start=start, end=start + 20 * len(ctx.uniqueScreens[(level, sublevel)]))
+                for uscreen in range(len(ctx.uniqueScreens[(level, sublevel)])):
+                    s, js = ctx.getUniqueScreenOriginalScreen(level, sublevel, uscreen)
+                    ctx.addProvenance(bank, start + 20 * uscreen, start + 20 * (uscreen + 1), f"{subrangekey} screen {s:X}", level=level, sublevel=sublevel, screen=s)
+                ctx.writeWord(tbank, tsaddr, start)
                 tsaddr += 2
-                for uscreen, uscm in enumerate(ctx.uniqueScreens[(level, sublevel)]):
-                    oscreen, js = ctx.getUniqueScreenOriginalScreen(level, sublevel, uscreen)
-                    for y in range(4):
-                        for x in range(5):
-                            # TODO: remap chunks also :)
-                            ctx.writeByte(bank, addr, js.data[y][x])
-                            addr += 1
-                subranges[subrangekey].end = addr
+    ctx.addProvenance(tbank, ctx.regions.ScreenTilesTable.addr, tsaddr, "ScreenTilesTable")
     ctx.regions.ScreenTilesTable.used = tsaddr - ctx.regions.ScreenTilesTable.addr
-    ctx.regions.ScreenTiles.used = addr - ctx.regions.ScreenTiles.addr
+    ctx.regions.ScreenTiles.used = len(data)
+    indexScreenTiles(ctx)
 
 # gives a (massive) over-approximation in cover sets for this sublevel
 def constructScreenCoverSets(ctx: SaveContext, level, sublevel):
@@ -1079,53 +1630,94 @@ def constructScreenCoverSets(ctx: SaveContext, level, sublevel):
     
     # This is NP complete, so we use an approximation.
     
-    csets = []
-    cvalues = set()
+    # returns the mask of occupied cells (see coordBit) and a list of candidate
+    # segments (mask, start, stride, length), where start is a layout address byte.
+    
+    # the game steps through the layout by adding the stride to a single address byte,
+    # so a horizontal run carries over into the next row rather than wrapping around its own.
+    
+    # a segment only ever ends on an occupied cell (trailing gaps would just cost bytes),
+    # and segments covering the same cells are deduplicated, keeping the shortest.
+    # segments are also dropped if another one covers more cells for no more bytes,
+    # as swapping it in can only improve a cover.
+    csets = dict()
     MAXMARGIN = 5 # because every packet requires 4 bytes of padding
     layout = constructRemappedLayout(ctx, level, sublevel, True)
+    universe = 0
     for x in range(16):
         for y in range(16):
             if layout[x][y] > 0:
-                cvalues.add((x, y))
-                cset = []
-                for xoff in range(0x10):
-                    if not any(layout[(x + xoff + i) % 0x10][y] for i in range(MAXMARGIN)):
-                        break
-                    else:
-                        if layout[(x + xoff) % 0x10][y] > 0:
-                            cset.append(((x + xoff) % 0x10, y))
-                        else:
-                            cset.append(((x + xoff) % 0x10, y, 0))
-                        csets.append(copy.copy(cset))
-                cset = []
-                for yoff in range(0x10):
-                    if not any(layout[x][(y + yoff + i) % 0x10] for i in range(MAXMARGIN)):
-                        break
-                    else:
-                        if layout[x][(y + yoff) % 0x10] > 0:
-                            cset.append((x, (y + yoff) % 0x10))
+                universe |= 1 << coordBit((x, y))
+    for x in range(16):
+        for y in range(16):
+            if layout[x][y] > 0:
+                start = coordBit((x, y))
+                for stride in [1, 0x10]:
+                    mask = 0
+                    gap = 0
+                    for length in range(1, 0x11):
+                        addr = (start + (length - 1) * stride) & 0xFF
+                        if (universe >> addr) & 1:
+                            gap = 0
+                            mask |= 1 << addr
+                            if mask not in csets or csets[mask][3] > length:
+                                csets[mask] = (mask, start, stride, length)
                         else:
-                            cset.append((x, (y + yoff) % 0x10, 0))
-                        csets.append(copy.copy(cset))
-    return cvalues, csets
+                            gap += 1
+                            if gap >= MAXMARGIN:
+                                break
+    
+    # any segment dominating another also covers each of its cells, so only
+    # the segments covering its least-covered cell need to be checked.
+    coverers = dict() # layout address -> list of segments covering it
+    for cset in csets.values():
+        for addr in range(0x100):
+            if (cset[0] >> addr) & 1:
+                coverers.setdefault(addr, []).append(cset)
+    candidates = []
+    for cset in csets.values():
+        mask, _, _, length = cset
+        cell = min((addr for addr in range(0x100) if (mask >> addr) & 1), key=lambda addr: len(coverers[addr]))
+        if not any(other[0] != mask and other[0] & mask == mask and other[3] <= length for other in coverers[cell]):
+            candidates.append(cset)
+    ctx.count("layoutCoverDominated", len(csets) - len(candidates))
+    return universe, candidates
+
+# lists the occupied cells of a cover segment which are in the given mask, in order
+def expandScreenCoverSet(cset, mask):
+    _, start, stride, length = cset
+    coords = []
+    for i in range(length):
+        addr = (start + i * stride) & 0xFF
+        if (mask >> addr) & 1:
+            coords.append((addr % 0x10, addr // 0x10))
+    return coords
 
+# the result is shared between callers for the rest of the compile; don't modify it.
 def constructRemappedLayout(ctx: SaveContext, level, sublevel, preview=False):
+    key = (level, sublevel, preview)
+    if key not in ctx.remappedLayouts:
+        ctx.remappedLayouts[key] = computeRemappedLayout(ctx, level, sublevel, preview)
+    return ctx.remappedLayouts[key]
+
+def computeRemappedLayout(ctx: SaveContext, level, sublevel, preview):
     jl = ctx.j.levels[level]
     jsl = jl.sublevels[sublevel]
     layout = copy.deepcopy(jsl.layout)
+    doors = ctx.getSublevelGraph(level, sublevel).doors if preview else None
     
     for x in range(16):
         for y in range(16):
             if jsl.layout[x][y] == 0 and x == jsl.startx and y == jsl.starty:
-                ctx.errors += [f"{jl.name}-{sublevel+1}: Start screen ({jsl.startx}, {jsl.starty}) is empty"]
+                ctx.addProblem(f"{jl.name}-{sublevel+1}: Start screen ({jsl.startx}, {jsl.starty}) is empty", level, sublevel, x, y)
             if jsl.layout[x][y] > 0:
                 layout[x][y] &= 0xF0
                 assert ctx.screenRemap[(level, sublevel, x, y)] < 0x10
                 layout[x][y] |= ctx.screenRemap[(level, sublevel, x, y)] & 0x0F
                 if preview:
-                    for xoff in getScreenExitDoor(ctx.j, level, sublevel, jsl.layout[x][y] & 0xF):
+                    for xoff in doors[jsl.layout[x][y] & 0xF]:
                         if jsl is jl.sublevels[-1]:
-                            ctx.errors += "Sublevel door on final sublevel of {jl.name}"
+                            ctx.addProblem(f"Sublevel door on final sublevel of {jl.name}", level, sublevel, x, y)
                         else:
                             jsl2 = jl.sublevels[sublevel+1]
                             previewDown = 1 if requiresVerticalPreview(jsl2) else 0
@@ -1137,50 +1729,278 @@ def constructRemappedLayout(ctx: SaveContext, level, sublevel, preview=False):
                                         #print(level, sublevel, f"{nextsublevelscreen:02X}", len(ctx.uniqueScreens[(level, sublevel)]))
                                         nextsublevelscreent = (nextsublevelscreen & 0x0F) + len(ctx.uniqueScreens[(level, sublevel)])
                                         if nextsublevelscreent >= 0x10:
-                                            ctx.errors += [f"{rom.LEVELS[level]}-{sublevel+1} uses more than 15 unique screens when including preview screens for {rom.LEVELS[level]}-{sublevel+2}"]
+                                            ctx.addProblem(f"{rom.LEVELS[level]}-{sublevel+1} uses more than 15 unique screens when including preview screens for {rom.LEVELS[level]}-{sublevel+2}", level, sublevel, x, y)
                                         _x = (x + xoff*(i+1) + 0x10) % 0x10
                                         _y = (y + j + 0x10) % 0x10
                                         if layout[_x][_y] > 0:
-                                            ctx.errors += [f"Unable to place next-sublevel-preview screen for {rom.LEVELS[level]}-{sublevel+1}, as it is coincident with an existing screen."]
+                                            ctx.addProblem(f"Unable to place next-sublevel-preview screen for {rom.LEVELS[level]}-{sublevel+1}, as it is coincident with an existing screen.", level, sublevel, _x, _y)
                                         else:
                                             layout[_x][_y] = nextsublevelscreent | 0x80
     return layout
                 
+# enterable cells whose unique screen is also used by an earlier enterable cell; entity data
+# can only be loaded for one of them (see produceEntityPackets). Enclosed (0xB*) screens may share.
+# returns a list of (x, y, uscreen)
+def getRepeatedEnterableScreens(ctx: SaveContext, level, sublevel):
+    layout = constructRemappedLayout(ctx, level, sublevel)
+    enterable = ctx.getSublevelGraph(level, sublevel).enterable
+    seen = set()
+    repeated = []
+    for x, col in enumerate(enterable):
+        for y, val in enumerate(col):
+            if val:
+                uscreen = layout[x][y] & 0x0F
+                if uscreen in seen and layout[x][y] & 0xF0 != 0xB0:
+                    repeated.append((x, y, uscreen))
+                seen.add(uscreen)
+    return repeated
+
+# maps (level, sublevel) -> (signature, problems)
+sublevelProblemsCache = dict()
+
+# validation of a sublevel only depends on it and on the start of the next sublevel (for preview screens).
+def getSublevelValidationSignature(j, level, sublevel):
+    jl = j.levels[level]
+    jsl = jl.sublevels[sublevel]
+    signature = [getSublevelGraphSignature(j, level, sublevel), requiresVerticalPreview(jsl), len(jl.sublevels) - sublevel]
+    if sublevel + 1 < len(jl.sublevels):
+        signature.append(getSublevelGraphSignature(j, level, sublevel + 1))
+        signature.append(requiresVerticalPreview(jl.sublevels[sublevel + 1]))
+    return tuple(signature)
+
+# finds the problems with this sublevel's layout that would otherwise only show up when compiling
+# (see SaveContext.addProblem), without compiling. Only rechecked if the sublevel changed since last time.
+def validateSublevel(j, level, sublevel):
+    if level == 0:
+        return []
+    signature = getSublevelValidationSignature(j, level, sublevel)
+    cached = sublevelProblemsCache.get((level, sublevel), None)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    
+    ctx = SaveContext(b"", j, quiet=True)
+    jl = j.levels[level]
+    try:
+        for _sublevel in range(sublevel, min(sublevel + 2, len(jl.sublevels))):
+            constructScreenRemappingForSublevel(ctx, level, _sublevel)
+        constructRemappedLayout(ctx, level, sublevel, True)
+        for x, y, uscreen in getRepeatedEnterableScreens(ctx, level, sublevel):
+            s, js = ctx.getUniqueScreenOriginalScreen(level, sublevel, uscreen)
+            ctx.addProblem(f"{jl.name}-{sublevel+1}: Same enterable room (screen {s:X}) appears twice in two enterable-screen contexts; second time at ({x},{y})", level, sublevel, x, y)
+    except Exception as e:
+        ctx.addProblem(f"{jl.name}-{sublevel+1}: {e}", level, sublevel)
+    
+    sublevelProblemsCache[(level, sublevel)] = (signature, ctx.problems)
+    return ctx.problems
+
+# problems across the whole hack (see validateSublevel)
+def validateHack(j):
+    problems = []
+    for level, jl in enumerate(j.levels):
+        for sublevel in range(len(jl.get("sublevels", []))):
+            problems += validateSublevel(j, level, sublevel)
+    return problems
+
+# a rough model of how many bytes a sublevel takes up in the regions which depend on it.
+# only differences between two results mean anything (see UsageEstimator):
+# - ScreenTiles: 20 bytes per distinct screen in the layout
+# - Ent*: per layout cell, 6 bytes per entity (4 in an enclosed room)
+# - Layouts: 1 byte per cell, plus 3 per run of cells along the scroll direction
+def estimateSublevelUsage(j, level, sublevel):
+    jsl = j.levels[level].sublevels[sublevel]
+    usage = JSONDict({"ScreenTiles": 0, "Layouts": 0})
+    for cat in CATS:
+        usage[f"Ent{cat}"] = 0
+    screens = set()
+    runs = 0
+    for x in range(16):
+        for y in range(16):
+            l = jsl.layout[x][y]
+            if l == 0 or (l & 0x0F) >= len(jsl.screens):
+                continue
+            js = jsl.screens[l & 0x0F]
+            screens.add(tuple(flatten(js.data)))
+            entsize = 4 if l >> 4 == 0xB else 6
+            for cat in CATS:
+                usage[f"Ent{cat}"] += entsize * len(js.get(cat, []))
+            px, py = (x, y - 1) if jsl.vertical else (x - 1, y)
+            if px < 0 or py < 0 or jsl.layout[px][py] == 0:
+                runs += 1
+            usage.Layouts += 1
+    usage.ScreenTiles = SCREEN_TILES_SIZE * len(screens)
+    usage.Layouts += 3 * runs
+    return usage
+
+# as above, for the regions which depend on a level as a whole (its chunks).
+def estimateLevelUsage(j, level):
+    jl = j.levels[level]
+    return JSONDict(ChunkValues=0x10 * max(len(jl.get("chunks", [])) - 1, 0))
+
+# keeps a running estimate of each region's usage between compiles, so that the editor can show
+# the effect of an edit straight away. Starts from the usage of the last compile (see reset), and adds
+# the change in estimateSublevelUsage / estimateLevelUsage for each sublevel edited since (see update).
+class UsageEstimator:
+    def __init__(self):
+        self.used = dict() # region name -> estimated bytes used
+        self.units = dict() # (level,) or (level, sublevel) -> their estimated usage as of self.used
+    
+    def getUnitUsage(self, j, key):
+        if len(key) == 1:
+            return estimateLevelUsage(j, *key)
+        return estimateSublevelUsage(j, *key)
+    
+    def getUnitKeys(self, j):
+        keys = []
+        for level, jl in enumerate(j.levels):
+            if level != 0:
+                keys.append((level,))
+                keys += [(level, sublevel) for sublevel in range(len(jl.sublevels))]
+        return keys
+    
+    # starts over from a compile's result; j is the hack as it was compiled.
+    def reset(self, j, regions):
+        self.used = {region.name: region.used for region in regions if region.used is not None}
+        self.units = {key: self.getUnitUsage(j, key) for key in self.getUnitKeys(j)}
+    
+    # brings the estimate up to date with the given sublevel (and its level), which may have been edited.
+    def update(self, j, level, sublevel=None):
+        keys = [(level,)] if sublevel is None else [(level,), (level, sublevel)]
+        for key in keys:
+            usage = self.getUnitUsage(j, key)
+            previous = self.units.get(key, None)
+            if previous is None or len(self.used) == 0:
+                # not in the last compile; can't say how it changed
+                continue
+            for name, n in usage.items():
+                if name in self.used:
+                    self.used[name] += n - previous.get(name, 0)
+            self.units[key] = usage
+    
+    # as update, for every sublevel (e.g. after edits elsewhere, or an undo outside of the current sublevel)
+    def updateAll(self, j):
+        for key in self.getUnitKeys(j):
+            if len(key) == 2:
+                self.update(j, *key)
+    
+    # estimated bytes used in the region, or None if unknown
+    def estimate(self, name):
+        return self.used.get(name, None)
+
+# layout cells as bits of a 256-bit int
+def coordBit(c):
+    return c[1] * 0x10 + c[0]
+
+def popcount(v):
+    return bin(v).count("1")
+
+# lazy greedy set cover: gains only ever shrink, so a popped entry whose
+# recomputed gain still matches its key is the best remaining choice.
+# ties prefer the shorter set.
+def solveCoverGreedy(universe, masks, costs):
+    heap = [(-popcount(mask & universe), costs[i], i) for i, mask in enumerate(masks) if mask & universe]
+    heapq.heapify(heap)
+    covered = 0
+    picks = []
+    while universe & ~covered:
+        assert len(heap) > 0
+        key, cost, i = heapq.heappop(heap)
+        gain = popcount(masks[i] & universe & ~covered)
+        if gain == 0:
+            continue
+        if gain != -key:
+            heapq.heappush(heap, (-gain, cost, i))
+            continue
+        picks.append(i)
+        covered |= masks[i]
+    return picks
+
+EXACT_COVER_MAX_SCREENS = 40
+
+class CoverSearchTimeout(Exception):
+    pass
+
+# branch-and-bound for the fewest sets (then lowest total cost).
+# returns the given greedy picks unless something strictly better is proven within the budget;
+# a search that runs out of time is discarded so that output does not depend on machine speed.
+def solveCoverExact(universe, masks, costs, greedyPicks, budget):
+    deadline = time.monotonic() + budget
+    masks = [mask & universe for mask in masks]
+    maxSize = max(popcount(mask) for mask in masks)
+    # candidate sets covering each cell, largest first
+    coverers = dict()
+    for b in range(0x100):
+        if (universe >> b) & 1:
+            coverers[b] = sorted([i for i, mask in enumerate(masks) if (mask >> b) & 1], key=lambda i: (-popcount(masks[i]), costs[i], i))
+    best = [len(greedyPicks), sum(costs[i] for i in greedyPicks), greedyPicks]
+    improved = [False]
+    
+    def search(covered, picks, cost):
+        if time.monotonic() > deadline:
+            raise CoverSearchTimeout()
+        uncovered = universe & ~covered
+        if uncovered == 0:
+            if (len(picks), cost) < (best[0], best[1]):
+                best[:] = [len(picks), cost, list(picks)]
+                improved[0] = True
+            return
+        bound = len(picks) + (popcount(uncovered) + maxSize - 1) // maxSize
+        if bound > best[0] or (bound == best[0] and cost >= best[1]):
+            return
+        # branch on the uncovered cell with the fewest options
+        cell = min((b for b in coverers if (uncovered >> b) & 1), key=lambda b: len(coverers[b]))
+        for i in coverers[cell]:
+            picks.append(i)
+            search(covered | masks[i], picks, cost + costs[i])
+            picks.pop()
+    
+    try:
+        search(0, [], 0)
+    except CoverSearchTimeout:
+        return greedyPicks
+    return best[2] if improved[0] else greedyPicks
+
 def produceScreenLayoutPackets(ctx: SaveContext, level, sublevel, addr):
     if level == 0:
         return None
     jsl = ctx.j.levels[level].sublevels[sublevel]
     layout = constructRemappedLayout(ctx, level, sublevel, True)
-    cvalues, csets = constructScreenCoverSets(ctx, level, sublevel)
+    
+    # the packets depend only on the remapped layout and start screen, so a sublevel
+    # that didn't change since an earlier compile can reuse them.
+    if ctx.compileCache is not None:
+        key = ("layout", tuple(tuple(col) for col in layout), jsl.startx, jsl.starty, ctx.exactCoverBudget)
+        if key in ctx.compileCache:
+            ctx.count("compileCacheHits")
+            return list(ctx.compileCache[key])
+        packets = computeScreenLayoutPackets(ctx, level, sublevel, layout)
+        ctx.compileCache[key] = tuple(packets)
+        return packets
+    return computeScreenLayoutPackets(ctx, level, sublevel, layout)
+
+def computeScreenLayoutPackets(ctx: SaveContext, level, sublevel, layout):
+    jsl = ctx.j.levels[level].sublevels[sublevel]
+    universe, csets = constructScreenCoverSets(ctx, level, sublevel)
+    masks = [cset[0] for cset in csets]
+    costs = [cset[3] for cset in csets]
+    picks = solveCoverGreedy(universe, masks, costs)
+    if ctx.exactCoverBudget is not None and popcount(universe) <= EXACT_COVER_MAX_SCREENS:
+        picks = solveCoverExact(universe, masks, costs, picks, ctx.exactCoverBudget)
+    
+    ctx.count("layoutCoverCandidates", len(csets))
+    ctx.count("layoutPackets", len(picks))
+    
+    # each picked set only needs to write the screens not already written by an earlier one
     outsets = []
-    def sortkey(cset):
-        # TODO: actually sensible sortkey
-        value = 0
-        for op in cset:
-            if len(op) == 2:
-                value += 1
-        return value
-    while len(cvalues) > 0:
-        assert len(csets) > 0
-        csets.sort(key=sortkey)
-        cset = csets[-1]
-        csets = csets[:-1]
-        outsets.append(copy.copy(cset))
-        removed = 0
-        for c in cset:
-            if len(c) == 2:
-                removed += 1
-                if c in cvalues:
-                    cvalues.remove(c)
-            for _cset in csets:
-                if c in _cset:
-                    _cset.remove(c)
-        assert removed > 0
-        csets = list(filter(lambda cset: any([len(c) == 2 for c in cset]), csets))
+    covered = 0
+    for i in picks:
+        remaining = masks[i] & ~covered
+        assert remaining != 0
+        outsets.append(expandScreenCoverSet(csets[i], remaining))
+        covered |= masks[i]
+    assert covered == universe
     
     packets = []
-    for outset in outsets:
-        coords = list(filter(lambda coord: len(coord) == 2, outset))
+    for coords in outsets:
         assert len(coords) > 0
         startx, starty = coords[0]
         stride = 0
@@ -1200,15 +2020,13 @@ def produceScreenLayoutPackets(ctx: SaveContext, level, sublevel, addr):
         i = 0
         
         entries = []
-        x, y = startx, starty
+        addr = startx | (starty << 4)
         for i in range(0x100):
+            x, y = addr % 0x10, addr // 0x10
             entries.append(layout[x][y])
             if (x, y) == coords[-1]:
                 break
-            x += stride % 0x10
-            y += stride // 0x10
-            x %= 0x10
-            y %= 0x10
+            addr = (addr + stride) & 0xFF
         
         packets.append([
             # write address
@@ -1230,11 +2048,121 @@ def produceScreenLayoutPackets(ctx: SaveContext, level, sublevel, addr):
 def writeScreenLayout(ctx: SaveContext):
     addr = ctx.regions.Layouts.addr
     bank = ctx.regions.Layouts.bank
-    addr = writeSublevelTableData(ctx, addr, bank, produceScreenLayoutPackets)
+    # layout packets contain no addresses, so identical ones can be shared.
+    addr = writeSublevelTableData(ctx, addr, bank, produceScreenLayoutPackets, allowMerging=True, label="Layout")
     ctx.regions.Layouts.used = addr - ctx.regions.Layouts.addr
 
-def rrange(a, b):
-    return range(b-1,a-1,-1)
+# finds earlier copies of a byte string among the bytes written so far (for merging identical hunks).
+# written bytes are kept as contiguous segments, and every substring of length up to K
+# is mapped to the addresses it starts at, so a lookup only needs to verify a few candidates.
+# matches never span two segments, since whatever lies between them might still change.
+class SubstringIndex:
+    K = 8
+    
+    def __init__(self):
+        self.starts = [] # segment start addresses, ascending
+        self.segments = [] # bytearray per segment
+        self.grams = dict() # bytes -> list of start addresses, ascending
+    
+    def append(self, addr, data):
+        if len(self.segments) > 0 and self.starts[-1] + len(self.segments[-1]) == addr:
+            seg = self.segments[-1]
+        else:
+            assert len(self.starts) == 0 or addr > self.starts[-1]
+            seg = bytearray()
+            self.starts.append(addr)
+            self.segments.append(seg)
+        segstart = self.starts[-1]
+        for b in data:
+            seg.append(b)
+            end = len(seg)
+            for k in range(1, min(self.K, end) + 1):
+                key = bytes(seg[end-k:end])
+                if key not in self.grams:
+                    self.grams[key] = []
+                self.grams[key].append(segstart + end - k)
+    
+    # returns the highest address at which data was written in full, or None
+    def find(self, data):
+        if len(data) == 0:
+            return None
+        data = bytes(data)
+        for addr in reversed(self.grams.get(data[:self.K], [])):
+            i = bisect.bisect_right(self.starts, addr) - 1
+            offset = addr - self.starts[i]
+            if self.segments[i][offset:offset + len(data)] == data:
+                return addr
+        return None
+
+# greedy shortest common superstring.
+# returns (superstring, offsets), where strings[i] starts at superstring[offsets[i]:];
+# or None if finding the containments and overlaps takes longer than budget (seconds).
+# output depends only on the input (ties go to the earliest strings).
+def packShortestSuperstring(strings, budget):
+    deadline = time.monotonic() + budget
+    strings = [bytes(string) for string in strings]
+    
+    # strings contained in another string are placed inside the longest string containing them
+    container = [None] * len(strings)
+    for i, string in enumerate(strings):
+        if time.monotonic() > deadline:
+            return None
+        best = None
+        for k, other in enumerate(strings):
+            if k != i and len(other) >= len(string) and (len(other) > len(string) or k < i) and string in other:
+                if best is None or len(other) > len(strings[best]):
+                    best = k
+        container[i] = best
+    pieces = [i for i in range(len(strings)) if container[i] is None]
+    
+    # overlap[(a, b)]: longest suffix of a which is a prefix of b
+    pairs = []
+    for a in pieces:
+        for b in pieces:
+            if a != b:
+                # (checked per pair, as each can take O(L^2) with long strings)
+                if time.monotonic() > deadline:
+                    return None
+                sa, sb = strings[a], strings[b]
+                for k in range(min(len(sa), len(sb)) - 1, 0, -1):
+                    if sa.endswith(sb[:k]):
+                        pairs.append((-k, a, b))
+                        break
+    pairs.sort()
+    
+    # join pieces greedily by largest overlap, never closing a cycle
+    succ = dict()
+    pred = dict()
+    head = {i: i for i in pieces}
+    for negk, a, b in pairs:
+        if a in succ or b in pred or head[a] == b:
+            continue
+        succ[a] = (b, -negk)
+        pred[b] = a
+        # b's chain now starts wherever a's does
+        h = head[a]
+        i = b
+        while True:
+            head[i] = h
+            if i not in succ:
+                break
+            i = succ[i][0]
+    
+    superstring = bytearray()
+    offsets = [None] * len(strings)
+    for i in pieces:
+        if i in pred:
+            continue
+        offsets[i] = len(superstring)
+        superstring += strings[i]
+        while i in succ:
+            i, k = succ[i]
+            offsets[i] = len(superstring) - k
+            superstring += strings[i][k:]
+    for i in range(len(strings)):
+        if container[i] is not None:
+            offsets[i] = offsets[container[i]] + strings[container[i]].find(strings[i])
+    return bytes(superstring), offsets
 
 def writeLevelTableData(ctx: SaveContext, addr, bank, cb, **kwargs):
     taddr = addr
@@ -1247,15 +2175,23 @@ def writeLevelTableData(ctx: SaveContext, addr, bank, cb, **kwargs):
             ctx.writeWord(bank, taddr, addr)
             taddr += 2
             v = cb(ctx, level, addr)
+            if "label" in kwargs:
+                ctx.addProvenance(bank, addr, addr + len(v), f"{kwargs['label']} {jl.name}", level=level)
             for byte in v:
                 ctx.writeByte(bank, addr, byte)
                 addr += 1
+    if "label" in kwargs:
+        ctx.addProvenance(bank, taddr - len(ctx.j.levels)*2, taddr, f"{kwargs['label']} table")
     return addr
 
 def writeSublevelTableData(ctx: SaveContext, addr, bank, cb, **kwargs):
     allowMerging = kwargs.get("allowMerging", False)
     tableAtStart = kwargs.get("tableAtStart", False)
     sbbase = kwargs.get("singleByteAddressBase", None)
+    # called as relocate(ctx, level, sublevel, delta) if a hunk is merged with an earlier copy
+    relocate = kwargs.get("relocate", None)
+    # names the hunks (and tables) for ctx.addProvenance
+    label = kwargs.get("label", None)
     taddr = addr
     addr += len(ctx.j.levels)*2
     
@@ -1264,7 +2200,8 @@ def writeSublevelTableData(ctx: SaveContext, addr, bank, cb, **kwargs):
         total_sublevels = sum(len(jl.sublevels) for jl in ctx.j.levels[1:])
         addr += total_sublevels * (1 if sbbase is not None else 2)
     
-    orgaddr = addr
+    # hunks are merged with an identical hunk written earlier in this table.
+    index = kwargs.get("substringIndex", None) or SubstringIndex()
     
     for level, jl in enumerate(ctx.j.levels):
         if level == 0:
@@ -1275,6 +2212,8 @@ def writeSublevelTableData(ctx: SaveContext, addr, bank, cb, **kwargs):
                 addr += len(jl.sublevels) * (1 if sbbase is not None else 2)
             ctx.writeWord(bank, taddr, tsaddr)
             taddr += 2
+            if label is not None:
+                ctx.addProvenance(bank, tsaddr, tsaddr + len(jl.sublevels) * (1 if sbbase is not None else 2), f"{label} table {jl.name}", level=level)
             for sublevel, jsl in enumerate(jl.sublevels):
                 def writeSubtableByte(addr):
                     if sbbase is None:
@@ -1283,34 +2222,90 @@ def writeSublevelTableData(ctx: SaveContext, addr, bank, cb, **kwargs):
                         ctx.writeByte(bank, tsaddr, addr - sbbase)
                 writeSubtableByte(addr)
                 rv = cb(ctx, level, sublevel, addr)
-                replaceAddr = None
+                replaceaddr = None
                 if type(rv) is tuple:
                     hunk, replaceaddr = rv
                     if replaceaddr is not None:
                         writeSubtableByte(replaceaddr)
                 else:
                     hunk = rv
-                if replaceAddr is None and allowMerging and len(hunk) > 0:
-                    hunk0 = hunk[0]
-                    mergeAddr = None
-                    lhunk = len(hunk)
-                    for iaddr in rrange(orgaddr, addr - lhunk+1):
-                        if hunk0 == ctx.readByte(bank, iaddr):
-                            if hunk == [ctx.readByte(bank, iaddr + i) for i in range(lhunk)]:
-                                mergeAddr = iaddr
-                                break
+                if replaceaddr is None and allowMerging and len(hunk) > 0:
+                    mergeAddr = index.find(hunk)
                     if mergeAddr is not None:
+                        ctx.count("tableHunksMerged")
+                        if label is not None:
+                            ctx.addProvenance(bank, mergeAddr, mergeAddr + len(hunk), f"{label} {jl.name}-{sublevel+1}", level=level, sublevel=sublevel)
+                        if relocate is not None:
+                            relocate(ctx, level, sublevel, mergeAddr - addr)
                         writeSubtableByte(mergeAddr)
                         tsaddr += 1 if sbbase is not None else 2
                         continue
                 tsaddr += 1 if sbbase is not None else 2
                 #if cb == produceSublevelInitRoutine and len(hunk) > 0:
                 #    print(level, sublevel, len(hunk), [f"{h:02X}" for h in hunk])
+                if allowMerging:
+                    index.append(addr, hunk)
+                if label is not None:
+                    ctx.addProvenance(bank, addr, addr + len(hunk), f"{label} {jl.name}-{sublevel+1}", level=level, sublevel=sublevel)
                 for b in hunk:
                     ctx.writeByte(bank, addr, b)
                     addr += 1
+    if label is not None:
+        ctx.addProvenance(bank, taddr - len(ctx.j.levels)*2, taddr, f"{label} table")
     return addr
 
+# like writeSublevelTableData with tableAtStart, but the hunks are then reordered and overlapped
+# (see packShortestSuperstring). cb is called with the address the hunk would have without packing;
+# if packing moves a hunk, relocate(ctx, level, sublevel, delta) is called.
+# hunks are laid out end to end as usual if packing runs out of time.
+def writePackedSublevelTableData(ctx: SaveContext, addr, bank, cb, budget, relocate=None, label=None):
+    taddr = addr
+    tsaddr = addr + len(ctx.j.levels)*2
+    addr = tsaddr + sum(len(jl.sublevels) for jl in ctx.j.levels[1:]) * 2
+    orgaddr = addr
+    
+    keys = []
+    hunks = []
+    for level, jl in enumerate(ctx.j.levels):
+        if level != 0:
+            for sublevel, jsl in enumerate(jl.sublevels):
+                hunk = cb(ctx, level, sublevel, addr)
+                assert type(hunk) is not tuple
+                keys.append((level, sublevel, addr))
+                hunks.append(hunk)
+                addr += len(hunk)
+    
+    packed = packShortestSuperstring(hunks, budget)
+    if packed is None:
+        data = flatten(hunks)
+        hunkaddrs = [key[2] for key in keys]
+    else:
+        data, offsets = packed
+        hunkaddrs = [orgaddr + offset for offset in offsets]
+        if relocate is not None:
+            for (level, sublevel, oldaddr), newaddr in zip(keys, hunkaddrs):
+                if newaddr != oldaddr:
+                    relocate(ctx, level, sublevel, newaddr - oldaddr)
+    
+    i = 0
+    for level, jl in enumerate(ctx.j.levels):
+        if level == 0:
+            taddr += 2
+        else:
+            ctx.writeWord(bank, taddr, tsaddr)
+            taddr += 2
+            for sublevel, jsl in enumerate(jl.sublevels):
+                ctx.writeWord(bank, tsaddr, hunkaddrs[i])
+                if label is not None:
+                    ctx.addProvenance(bank, hunkaddrs[i], hunkaddrs[i] + len(hunks[i]), f"{label} {jl.name}-{sublevel+1}", level=level, sublevel=sublevel)
+                tsaddr += 2
+                i += 1
+    if label is not None:
+        ctx.addProvenance(bank, taddr - len(ctx.j.levels)*2, orgaddr, f"{label} table")
+    
+    ctx.writeBytes(bank, orgaddr, data)
+    return orgaddr + len(data)
+
 def writeSublevelTimer(ctx: SaveContext):
     if rom.ROMTYPE != "us":
         return
@@ -1320,7 +2315,8 @@ def writeSublevelTimer(ctx: SaveContext):
     
     addr = writeLevelTableData(
         ctx, addr, bank,
-        lambda ctx, level, addr: [sublevel.timer for sublevel in ctx.j.levels[level].sublevels]
+        lambda ctx, level, addr: [sublevel.timer for sublevel in ctx.j.levels[level].sublevels],
+        label="Timer"
     )
     
     ctx.regions.SublevelTime.used = addr - ctx.regions.SublevelTime.addr
@@ -1396,6 +2392,7 @@ def writeSublevelVertical(ctx: SaveContext):
                     else:
                         table[sublevel] |= lsh(level-1)
     
+    ctx.addProvenance(bank, addr, addr + len(data) + len(table), "SublevelVertical")
     for b in data + table:
         ctx.writeByte(bank, addr, b)
         addr += 1
@@ -1449,7 +2446,7 @@ def produceEntityPackets(ctx: SaveContext, level, sublevel, cat, addr):
     jsl = ctx.j.levels[level].sublevels[sublevel]
     vertical = jsl.vertical == 1
     layout = constructRemappedLayout(ctx, level, sublevel)
-    enterable = getEnterabilityLayout(ctx.j, level, sublevel)
+    enterable = ctx.getSublevelGraph(level, sublevel).enterable
     processed = [[None for y in range(16)] for x in range(16)] # (x, y) -> seckey | None
     
     SLOTMAX = {"misc": 8, "enemies": 8, "items": 4}[cat]
@@ -1465,6 +2462,7 @@ def produceEntityPackets(ctx: SaveContext, level, sublevel, cat, addr):
                 entsc[x][y] = js[cat]
     
     packets = []
+    packetIndices = dict() # (condensed, data) -> packet index
     screenPacketOffset = dict() # (x, y) -> packetoffset
     enterablekeys = dict() # (x, y) -> packet index
             
@@ -1495,13 +2493,15 @@ def produceEntityPackets(ctx: SaveContext, level, sublevel, cat, addr):
                     packet.data.extend(data)
             
             # reuse previous packet if identical to this one
-            for i, prevpacket in enumerate(packets):
-                if prevpacket.data == packet.data and prevpacket.condensed == packet.condensed:
-                    enterablekeys[seckey] = i
-                    break
+            packetkey = (packet.condensed, tuple(packet.data))
+            ctx.count("entityPackets")
+            if packetkey in packetIndices:
+                ctx.count("entityPacketsReused")
+                enterablekeys[seckey] = packetIndices[packetkey]
             else:
                 # new packet!
                 enterablekeys[seckey] = len(packets)
+                packetIndices[packetkey] = len(packets)
                 packets.append(packet)
     
     # sort packets so that the non-empty non-condensed packets come first
@@ -1515,7 +2515,9 @@ def produceEntityPackets(ctx: SaveContext, level, sublevel, cat, addr):
             return 0
             
     remapPacketsIndices = sorted(list(range(len(packets))), key=getPacketPriority) # (new packet index) -> (old packet index)
-    remapPackets = [remapPacketsIndices.index(i) for i in range(len(packets))] # (old packet index) -> (new packet index)
+    remapPackets = [None] * len(packets) # (old packet index) -> (new packet index)
+    for i, oldi in enumerate(remapPacketsIndices):
+        remapPackets[oldi] = i
     packets = [packets[remapPacketsIndices[i]] for i in range(len(packets))]
     
     for seckey, packetidx in enterablekeys.items():
@@ -1546,6 +2548,18 @@ def produceEntityPackets(ctx: SaveContext, level, sublevel, cat, addr):
     
     data.append(0xFD)
     
+    # which room each packet is for (the first, if it's shared), for ctx.provenance
+    if ctx.provenance is not None:
+        sources = []
+        for (x, y), i in enterablekeys.items():
+            if packetStartByIdx[i] is not None and not any(source[2].packet == i for source in sources):
+                s, js = ctx.getUniqueScreenOriginalScreen(level, sublevel, layout[x][y] & 0x0F)
+                sources.append([addr + packetStartByIdx[i], addr + packetEndByIdx[i], JSONDict(
+                    label=f"{cat} {ctx.j.levels[level].name}-{sublevel+1} ({x},{y})",
+                    level=level, sublevel=sublevel, screen=s, cat=cat, x=x, y=y, packet=i
+                )])
+        ctx.entityPacketSources[(level, sublevel, cat)] = sources
+    
     # now let's record the start and end addresses for each enterable room
     for x, y in enterableCoords:
         uscreen = layout[x][y] & 0x0F
@@ -1590,6 +2604,17 @@ def produceEntityPackets(ctx: SaveContext, level, sublevel, cat, addr):
     
     return data
 
+# adjusts the addresses recorded by produceEntityPackets after its hunk has been moved
+def relocateEntityPackets(ctx: SaveContext, level, sublevel, cat, delta):
+    for key, edata in ctx.enterableScreenData.items():
+        if key[:3] == (level, sublevel, cat):
+            for field in ["secaddr", "eaddr", "endaddr"]:
+                if field in edata:
+                    edata[field] += delta
+    for source in ctx.entityPacketSources.get((level, sublevel, cat), []):
+        source[0] += delta
+        source[1] += delta
+
 def produceEntityLookupPackets(ctx: SaveContext, level, sublevel, addr):
     # get number of priority rooms
     numPriorityUniqueScreens = ctx.numPriorityUniqueScreens[(level, sublevel)]
@@ -1641,6 +2666,108 @@ def writePlaytestStart(ctx: SaveContext, level, sublevel=0):
     ctx.writeBytes(0, rom.TITLE_DONEFADE, data)
     addr = rom.TITLE_DONEFADE + len(data)
 
+# the level whose chunk list this level uses
+def getChunkOwner(j, level):
+    while j.levels[level].get("chunks", None) is None:
+        level = j.levels[level].chunklink
+    return level
+
+# every grid of chunk indices in the hack: list of (level whose chunks it uses, rows).
+# rows is a list of lists of chunk indices, and can be modified in place.
+# special screens which link to a screen (rather than holding data) are returned separately, as
+# list of (level whose chunks it uses, level of the linked screen).
+def getChunkGrids(j):
+    grids = []
+    links = []
+    def addRoutines(routines):
+        for routine in routines or []:
+            specs = [routine] if routine.type == "SCREEN" else routine.levels if routine.type == "LVLSCREEN" else []
+            for spec in specs:
+                if "linkscreen" in spec:
+                    links.append((spec.level, spec.linkscreen[0]))
+                elif type(spec.get("data", None)) == list and len(spec.data) == 20:
+                    grids.append((spec.level, [spec.data]))
+    for level, jl in enumerate(j.levels):
+        for jsl in jl.get("sublevels", []):
+            for js in jsl.screens:
+                grids.append((level, js.data))
+            addRoutines(jsl.get("initRoutines", None))
+    for key in ["entC4Routine", "ent78Routine", "crusherRoutine"]:
+        addRoutines(j.get(key, None))
+    return grids, links
+
+# the chunk lists which compactChunks may renumber: set of levels.
+# each level's chunks (but for chunk 0) are laid out end to end in the rom, in level order, so a screen using an index
+# past the end of its level's chunks reads a later level's ("glitch chunks"). Every chunk list from the one such a read
+# starts in to the one it ends in has to keep its chunks exactly where they are.
+def getCompactableChunkLevels(j, grids, links):
+    owners = [level for level, jl in enumerate(j.levels) if level > 0 and jl.get("chunks", None) is not None]
+    start = dict()
+    position = 0
+    for level in owners:
+        start[level] = position
+        position += len(j.levels[level].chunks) - 1
+    
+    maxIndex = {level: 0 for level in owners}
+    for level, rows in grids:
+        owner = getChunkOwner(j, level)
+        maxIndex[owner] = max([maxIndex[owner]] + [chidx for row in rows for chidx in row])
+    
+    compactable = set(owners)
+    for level in owners:
+        if maxIndex[level] >= len(j.levels[level].chunks):
+            end = start[level] + maxIndex[level] - 1
+            compactable -= set(other for other in owners if other >= level and start[other] <= end)
+    
+    # a special screen showing another level's screen with its own level's chunks
+    for level, linkedLevel in links:
+        if getChunkOwner(j, level) != getChunkOwner(j, linkedLevel):
+            compactable -= {getChunkOwner(j, level), getChunkOwner(j, linkedLevel)}
+    return compactable
+
+# merges identical chunks and drops chunks that no screen or special screen uses, renumbering the screens to match.
+# works on a copy of the hack (ctx.j is replaced), so the caller's data is left alone.
+# chunk lists that glitch chunks are read from are left exactly as they are (see getCompactableChunkLevels).
+# note that this also renumbers any chunk which only the game's own code refers to, so it is opt-in.
+def compactChunks(ctx: SaveContext):
+    ctx.j = copy.deepcopy(ctx.j)
+    j = ctx.j
+    grids, links = getChunkGrids(j)
+    compactable = getCompactableChunkLevels(j, grids, links)
+    
+    remaps = JSONDict()
+    for owner in sorted(compactable):
+        chunks = j.levels[owner].chunks
+        used = set(chidx for level, rows in grids if getChunkOwner(j, level) == owner for row in rows for chidx in row)
+        
+        # chunk 0 is always empty, and not stored
+        remap = [0] + [None] * (len(chunks) - 1)
+        newChunks = [chunks[0]]
+        indices = dict() # chunk -> new index
+        for chidx in range(1, len(chunks)):
+            if chidx not in used:
+                ctx.count("chunksDropped")
+                continue
+            key = tuple(chunks[chidx])
+            if key in indices:
+                ctx.count("chunksMerged")
+            else:
+                indices[key] = len(newChunks)
+                newChunks.append(chunks[chidx])
+            remap[chidx] = indices[key]
+        
+        j.levels[owner].chunks = newChunks
+        renumbered = set() # (rows can be shared between screens)
+        for level, rows in grids:
+            if getChunkOwner(j, level) == owner:
+                for row in rows:
+                    if id(row) not in renumbered:
+                        renumbered.add(id(row))
+                        row[:] = [remap[chidx] for chidx in row]
+        remaps[rom.LEVELS[owner]] = remap
+    
+    ctx.addDebugArtifact("chunks.json", remaps)
+
 def writeChunks(ctx: SaveContext):
     tbank = ctx.regions.ChunkTable.bank
     taddr = ctx.regions.ChunkTable.addr
@@ -1658,7 +2785,8 @@ def writeChunks(ctx: SaveContext):
                 ctx.writeWord(tbank, taddr, addr)
                 addrs.append(addr)
                 taddr += 2
-                for chunk in jl.chunks[1:]:
+                for chidx, chunk in enumerate(jl.chunks[1:], 1):
+                    ctx.addProvenance(bank, addr, addr + len(chunk), f"{jl.name} chunk {chidx:X}", level=level, chunk=chidx)
                     for t in chunk:
                         ctx.writeByte(bank, addr, t)
                         addr += 1
@@ -1668,25 +2796,150 @@ def writeChunks(ctx: SaveContext):
                 ctx.writeWord(bank, taddr, addrs[jl.chunklink])
                 taddr += 2
     
+    ctx.addProvenance(tbank, ctx.regions.ChunkTable.addr, taddr, "ChunkTable")
     ctx.regions.ChunkTable.used = taddr - ctx.regions.ChunkTable.addr
     ctx.regions.ChunkValues.used = addr - ctx.regions.ChunkValues.addr
 
 def writeEntities(ctx: SaveContext):
     for cat in CATS:
-        region = ctx.regions[f"Ent{cat}"]
-        addr = region.addr
-        bank = region.bank
-        addr = writeSublevelTableData(ctx, addr, bank, lambda ctx, level, sublevel, addr: produceEntityPackets(ctx, level, sublevel, cat, addr))
-        region.used = addr - region.addr
-    
+        ctx.phase(f"writeEntities.{cat}", writeEntityCategory, ctx, cat)
+    ctx.phase("writeEntities.lookup", writeEntityLookup, ctx)
+
+def writeEntityCategory(ctx: SaveContext, cat):
+    region = ctx.regions[f"Ent{cat}"]
+    addr = region.addr
+    bank = region.bank
+    cb = lambda ctx, level, sublevel, addr: produceEntityPackets(ctx, level, sublevel, cat, addr)
+    relocate = lambda ctx, level, sublevel, delta: relocateEntityPackets(ctx, level, sublevel, cat, delta)
+    if ctx.packBudget is not None:
+        addr = writePackedSublevelTableData(ctx, addr, bank, cb, ctx.packBudget, relocate, label=f"Ent{cat}")
+    else:
+        # entity offsets are single bytes relative to the start of the sublevel's hunk,
+        # so sublevels can only share storage for their hunk as a whole.
+        addr = writeSublevelTableData(ctx, addr, bank, cb, allowMerging=True, relocate=relocate, label=f"Ent{cat}")
+    region.used = addr - region.addr
+    # the packets are where they'll stay now
+    for key, sources in ctx.entityPacketSources.items():
+        if key[2] == cat:
+            for start, end, source in sources:
+                ctx.addProvenance(bank, start, end, **source)
+
+def writeEntityLookup(ctx: SaveContext):
     addr = ctx.regions.EntLookup.addr
     bank = ctx.regions.EntLookup.bank
-    addr = writeSublevelTableData(ctx, addr, bank, produceEntityLookupPackets)
+    addr = writeSublevelTableData(ctx, addr, bank, produceEntityLookupPackets, label="EntLookup")
     ctx.regions.EntLookup.used = addr -  ctx.regions.EntLookup.addr
 
-def debugWriteBytes(path, b):
-    with open(path, "wb") as f:
-        f.write(bytes(b))
+# ------------------------------------------------------
+# parallel compile
+
+# regions which only depend on the screen remapping, and not on each other.
+# task name -> (regions written)
+PARALLEL_TASKS = {
+    "ScreenTiles": ["ScreenTiles", "ScreenTilesTable"],
+    "Layouts": ["Layouts"],
+    **{f"Ent{cat}": [f"Ent{cat}"] for cat in CATS},
+    "Chunks": ["ChunkTable", "ChunkValues"],
+}
+
+# task name -> profiling phase name, as in writeRom
+PARALLEL_TASK_PHASES = {
+    "ScreenTiles": "writeScreenTiles",
+    "Layouts": "writeScreenLayout",
+    **{f"Ent{cat}": f"writeEntities.{cat}" for cat in CATS},
+    "Chunks": "writeChunks",
+}
+
+def runParallelTask(ctx: SaveContext, name):
+    if name == "ScreenTiles":
+        writeScreenTiles(ctx)
+    elif name == "Layouts":
+        writeScreenLayout(ctx)
+    elif name == "Chunks":
+        writeChunks(ctx)
+    else:
+        writeEntityCategory(ctx, name[3:])
+
+# the rom the worker process last loaded (see rom.readrom)
+parallelWorkerRom = [None]
+
+# runs in a worker process. Returns everything writeRegionsParallel needs to
+# replay the task's effects on the main context.
+def parallelWorker(name, gb, j, options, state, profile, provenance):
+    if parallelWorkerRom[0] != gb:
+        rom.readrom(gb)
+        parallelWorkerRom[0] = gb
+    ctx = SaveContext(gb, j, **options)
+    ctx.profile = Profile() if profile else None
+    ctx.provenance = ProvenanceIndex() if provenance else None
+    ctx.uniqueScreens, ctx.screenRemap, ctx.numPriorityUniqueScreens, ctx.remappedLayouts = state
+    ctx.phase(PARALLEL_TASK_PHASES[name], runParallelTask, ctx, name)
+    regions = {key: (ctx.regions[key].used, ctx.regions[key].subranges) for key in PARALLEL_TASKS[name]}
+    if name == "ScreenTiles":
+        side = (ctx.screenTilesIndex, ctx.screenTilesIndexed)
+    elif name.startswith("Ent"):
+        side = {key: edata for key, edata in ctx.enterableScreenData.items() if key[2] == name[3:]}
+    else:
+        side = None
+    entries = ctx.provenance.entries if provenance else None
+    return ctx.writeLog, ctx.errors, regions, side, ctx.profile, entries
+
+# does the same as the serial part of writeRom from writeScreenTiles to writeChunks,
+# but compiles the independent regions in worker processes.
+# results are merged in the serial order, so the output is identical.
+def writeRegionsParallel(ctx: SaveContext):
+    # the remapped layouts are the only source of errors in these regions;
+    # computing them all up front (in the order the serial compile first requests them)
+    # gives the same errors, and saves each worker from recomputing them.
+    for preview in [True, False]:
+        for level, jl in enumerate(ctx.j.levels):
+            if level != 0:
+                for sublevel in range(len(jl.sublevels)):
+                    constructRemappedLayout(ctx, level, sublevel, preview)
+    
+    executor = ctx.executor
+    if executor is None:
+        workers = None if ctx.parallel is True else ctx.parallel
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    try:
+        gb = bytes(ctx.gb)
+        options = {key: value for key, value in ctx.options.items() if key not in ["parallel", "executor", "debugDir", "compileCache", "profile", "provenance", "freeRanges"]}
+        # the free ranges have already been checked (and any errors reported) here
+        options["freeRanges"] = ctx.acceptedFreeRanges
+        state = (ctx.uniqueScreens, ctx.screenRemap, ctx.numPriorityUniqueScreens, ctx.remappedLayouts)
+        futures = {
+            name: executor.submit(parallelWorker, name, gb, ctx.j, options, state, ctx.profile is not None, ctx.provenance is not None)
+            for name in PARALLEL_TASKS
+        }
+        
+        def merge(name):
+            log, errors, regions, side, profile, entries = futures[name].result()
+            if ctx.profile is not None:
+                ctx.profile.merge(profile)
+            if ctx.provenance is not None:
+                for romaddr, source in entries:
+                    ctx.provenance.add(romaddr, source)
+            ctx.applyWriteLog(log)
+            ctx.errors += errors
+            for key, (used, subranges) in regions.items():
+                ctx.regions[key].used = used
+                ctx.regions[key].subranges = subranges
+            if name == "ScreenTiles":
+                ctx.screenTilesIndex, ctx.screenTilesIndexed = side
+            elif name.startswith("Ent"):
+                ctx.enterableScreenData.update(side)
+        
+        merge("ScreenTiles")
+        merge("Layouts")
+        ctx.phase("writeSublevelTimer", writeSublevelTimer, ctx)
+        ctx.phase("writeSublevelVertical", writeSublevelVertical, ctx)
+        for cat in CATS:
+            merge(f"Ent{cat}")
+        ctx.phase("writeEntities.lookup", writeEntityLookup, ctx)
+        merge("Chunks")
+    finally:
+        if ctx.executor is None:
+            executor.shutdown()
 
 def writeSublevelInitRoutines(ctx: SaveContext):
     region = ctx.regions.SublevelInitRoutines
@@ -1704,14 +2957,13 @@ def writeSublevelInitRoutines(ctx: SaveContext):
         0xE9 #jp hl
     ]
     assert len(data) == DATALEN, f"{len(data)}"
+    ctx.addProvenance(bank, addr, addr + DATALEN, "Init routine")
     for b in data:
         ctx.writeByte(bank, addr, b)
         addr += 1
     
-    addr = writeSublevelTableData(ctx, addr, bank, produceSublevelInitRoutine, allowMerging=True, tableAtStart=True, singleByteAddressBase=addr)
+    addr = writeSublevelTableData(ctx, addr, bank, produceSublevelInitRoutine, allowMerging=True, tableAtStart=True, singleByteAddressBase=addr, label="Init")
     region.used = addr - ctx.regions.SublevelInitRoutines.addr
-    
-    debugWriteBytes("debugout.bin", [ctx.readByte(bank, i) for i in range(region.addr, region.addr + region.used)])
 
 def word(w, littleEndian=True):
     if littleEndian:
@@ -1911,6 +3163,7 @@ def writeEntLoadRoutine(ctx, region, routines, ret=True, **kwargs):
             ctx.writeByte(bank, addr, 0) # nop
             addr += 1
     
+    ctx.addProvenance(bank, region.addr, addr, label)
     region.used = addr - region.addr
 
 def produceSublevelInitRoutine(ctx, level, sublevel, addr):
@@ -2032,33 +3285,65 @@ def getAddressForScreenOrAddScreen(ctx: SaveContext, data, **kwargs):
                         return data.srcAddr
             data = data.data
         else:
-            level, sublevel, screen = data.linksceen
-            data = ctx.levels[level].sublevel[sublevel].screens[screen]
+            level, sublevel, screen = data.linkscreen
+            data = flatten(ctx.j.levels[level].sublevels[sublevel].screens[screen].data)
     
     label = kwargs.get("label", "Unk" + hashlib.md5(bytes(data)).hexdigest()[:8])
     
     dc = len(data)
-    zdata = data[0]
-    z2data = data[1]
-    for startaddr in range(addr, addr + region.used-len(data)+1):
-        if ctx.readByte(bank, startaddr) == zdata:
-            if ctx.readByte(bank, startaddr+1) == z2data:
-                if [ctx.readByte(bank, startaddr+i) for i in range(dc)] == data:
-                    return startaddr
+    ctx.count("screenTilesLookups")
+    if dc == SCREEN_TILES_SIZE:
+        indexScreenTiles(ctx)
+        startaddr = ctx.screenTilesIndex.get(bytes(data), None)
+        if startaddr is not None:
+            return startaddr
     else:
-        if region.max - region.used < dc:
-            ctx.errors += ["Need to insert extra screen, but not enough room in screen bank."]
-            region.used += dc
-            return 0
-        else:
-            addr = region.addr + region.used
-            for i, d in enumerate(data):
-                ctx.writeByte(bank, i + addr, d)
-            while label in region.subranges:
-                label += "*"
-            region.subranges[label] = JSONDict(start=addr, end=addr+dc)
-            region.used += dc
+        for startaddr in range(addr, addr + region.used-len(data)+1):
+            if [ctx.readByte(bank, startaddr+i) for i in range(dc)] == data:
+                return startaddr
+    
+    if region.max - region.used < dc:
+        # elsewhere in the same bank, then.
+        found = ctx.allocate(dc, bank, label=label)
+        if found is not None:
+            _, addr = found
+            ctx.writeBytes(bank, addr, data)
+            if dc == SCREEN_TILES_SIZE:
+                ctx.screenTilesIndex.setdefault(bytes(data), addr)
+            ctx.count("screenTilesOverflowed")
             return addr
+        ctx.errors += ["Need to insert extra screen, but not enough room in screen bank."]
+        region.used += dc
+        return 0
+    else:
+        addr = region.addr + region.used
+        for i, d in enumerate(data):
+            ctx.writeByte(bank, i + addr, d)
+        while label in region.subranges:
+            label += "*"
+        region.subranges[label] = JSONDict(start=addr, end=addr+dc)
+        ctx.addProvenance(bank, addr, addr+dc, label)
+        region.used += dc
+        ctx.count("screenTilesAdded")
+        return addr
+
+SCREEN_TILES_SIZE = 20
+
+# brings ctx.screenTilesIndex up to date with whatever was written to the ScreenTiles region
+# since it was last called. Every 20-byte window is indexed, aligned to a screen or not.
+def indexScreenTiles(ctx: SaveContext):
+    region = ctx.regions.ScreenTiles
+    end = region.used
+    if end <= ctx.screenTilesIndexed:
+        return
+    # windows ending in the new bytes
+    start = max(ctx.screenTilesIndexed - (SCREEN_TILES_SIZE - 1), 0)
+    window = bytes(ctx.readByte(region.bank, region.addr + i) for i in range(start, end))
+    for i in range(len(window) - SCREEN_TILES_SIZE + 1):
+        key = window[i:i + SCREEN_TILES_SIZE]
+        if key not in ctx.screenTilesIndex:
+            ctx.screenTilesIndex[key] = region.addr + start + i
+    ctx.screenTilesIndexed = end
 
 def writeLoadLayoutPatch(ctx: SaveContext):
     bank = rom.BANK6
@@ -2078,26 +3363,21 @@ def writeLoadEnclosedScreenEntityBugfixPatch(ctx: SaveContext):
     # we correct for it by subtracting 2
     # just need to find some free space to jump to.
     
-    for name, region in ctx.regions.items():
-        if region.bank == rom.BANK3 and region.max - region.used > 5:
-            addr = region.addr + region.used
-            detour_from = rom.BSCREEN_BUGFIX_DETOUR+1
-            detour_to = ctx.readWord(rom.BANK3, rom.BSCREEN_BUGFIX_DETOUR+1)
-            ctx.writeWord(rom.BANK3, detour_from, addr)
-            
-            #print(f"Bugfix patch; detour from ${detour_from:04X} to ${detour_to:04X} tramp ${addr:04X}")
-            
-            data = [
-                0x2b, # dec hl
-                0x2b, # dec hl
-                0xc3, (detour_to & 0xFF), (detour_to >> 8) # jp detour_to
-            ]
-            for b in data:
-                ctx.writeByte(rom.BANK3, addr, b)
-                addr += 1
-            
-            region.used += 5
-            return
-    else:
+    found = ctx.allocate(5, rom.BANK3, label="BScreenBugfix")
+    if found is None:
         ctx.errors += [f"Unable to find enough room in bank ${rom.BANK3:X} to fix enclosed-screen entity loading routine bug."]
+        return
+    
+    _, addr = found
+    detour_from = rom.BSCREEN_BUGFIX_DETOUR+1
+    detour_to = ctx.readWord(rom.BANK3, rom.BSCREEN_BUGFIX_DETOUR+1)
+    ctx.writeWord(rom.BANK3, detour_from, addr)
+    
+    #print(f"Bugfix patch; detour from ${detour_from:04X} to ${detour_to:04X} tramp ${addr:04X}")
+    
+    ctx.writeBytes(rom.BANK3, addr, [
+        0x2b, # dec hl
+        0x2b, # dec hl
+        0xc3, (detour_to & 0xFF), (detour_to >> 8) # jp detour_to
+    ])
     
\ No newline at end of file
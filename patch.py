@@ -0,0 +1,86 @@
+# IPS and BPS patch encoding.
+# both take the original and modified images, plus the (sorted, non-overlapping)
+# list of (start, end) ranges which might differ -- nothing outside of them is compared.
+
+import zlib
+
+IPS_MAX_RECORD = 0xFFFF
+IPS_EOF = 0x454F46 # a record at this offset would read as the "EOF" marker
+
+# splits the given ranges into runs of bytes which actually differ.
+# unchanged gaps shorter than `bridge` are kept inside a run, as a new record would cost more.
+def getDifferingRanges(source, target, ranges, bridge=0):
+    runs = []
+    for start, end in ranges:
+        runstart = None
+        runend = None
+        for i in range(start, end):
+            if source[i] != target[i]:
+                if runstart is not None and i - runend <= bridge:
+                    runend = i + 1
+                else:
+                    if runstart is not None:
+                        runs.append((runstart, runend))
+                    runstart, runend = i, i + 1
+        if runstart is not None:
+            runs.append((runstart, runend))
+    return runs
+
+def makeIPS(source, target, ranges):
+    assert len(source) == len(target)
+    if len(target) > 0x1000000:
+        raise Exception("IPS patches can't address more than 16MiB")
+    out = bytearray(b"PATCH")
+    for start, end in getDifferingRanges(source, target, ranges, 5):
+        if start == IPS_EOF:
+            start -= 1
+        while start < end:
+            size = min(end - start, IPS_MAX_RECORD)
+            if start + size == IPS_EOF and start + size < end:
+                # the next record can't begin at "EOF"
+                size -= 1
+            out += start.to_bytes(3, "big")
+            out += size.to_bytes(2, "big")
+            out += target[start:start + size]
+            start += size
+    out += b"EOF"
+    return bytes(out)
+
+def bpsNumber(n):
+    out = bytearray()
+    while True:
+        x = n & 0x7F
+        n >>= 7
+        if n == 0:
+            out.append(0x80 | x)
+            return out
+        out.append(x)
+        n -= 1
+
+BPS_SOURCE_READ = 0
+BPS_TARGET_READ = 1
+
+def makeBPS(source, target, ranges):
+    assert len(source) == len(target)
+    out = bytearray(b"BPS1")
+    out += bpsNumber(len(source))
+    out += bpsNumber(len(target))
+    out += bpsNumber(0) # no metadata
+
+    def action(command, length):
+        out.extend(bpsNumber(((length - 1) << 2) | command))
+
+    offset = 0
+    for start, end in getDifferingRanges(source, target, ranges, 1):
+        if start > offset:
+            action(BPS_SOURCE_READ, start - offset)
+        action(BPS_TARGET_READ, end - start)
+        out += target[start:end]
+        offset = end
+    if offset < len(target):
+        action(BPS_SOURCE_READ, len(target) - offset)
+
+    out += (zlib.crc32(source) & 0xFFFFFFFF).to_bytes(4, "little")
+    out += (zlib.crc32(target) & 0xFFFFFFFF).to_bytes(4, "little")
+    out += (zlib.crc32(out) & 0xFFFFFFFF).to_bytes(4, "little")
+    return bytes(out)